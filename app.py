@@ -1,12 +1,20 @@
 import os
+import re
 import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
 import oracledb
-from flask import Flask, request, jsonify
+import orjson
+import fastjsonschema
+from fastjsonschema import JsonSchemaException
+from flask import Flask, request, jsonify, stream_with_context
 from flask_cors import CORS
-from contextlib import contextmanager
-from decimal import Decimal, ROUND_HALF_UP # Importado para precisión
-import traceback
-from datetime import datetime, date
+from contextlib import contextmanager, ExitStack
+from decimal import Decimal # Importado para precisión
+from datetime import datetime
 
 # --- Configuración de Logging y Oracle Client ---
 python_init_logger = logging.getLogger("PYTHON_INIT")
@@ -17,18 +25,23 @@ if not python_init_logger.handlers:
     handler.setFormatter(formatter)
     python_init_logger.addHandler(handler)
 
+# Modo Thin (por defecto): sin librerías de Oracle Client. El modo Thick queda como opción con ORACLE_THICK=1
+# (solo hace falta para funcionalidades exclusivas de Thick: AQ, CQN, verificadores de contraseña antiguos, etc.)
 instant_client_dir_path = os.environ.get('ORACLE_CLIENT_LIB_DIR')
-try:
-    if instant_client_dir_path:
-        python_init_logger.info(f"Intentando inicializar Oracle Client (Modo Thick) desde: {instant_client_dir_path}")
-        oracledb.init_oracle_client(lib_dir=instant_client_dir_path)
-    else:
-        python_init_logger.info("ORACLE_CLIENT_LIB_DIR no configurado. Intentando inicializar Oracle Client (Modo Thick) usando PATH del sistema o configuración por defecto...")
-        oracledb.init_oracle_client()
-    python_init_logger.info(f"Oracle Client (Modo Thick) inicializado exitosamente. Version: {'.'.join(map(str, oracledb.clientversion()))}")
-except Exception as e:
-    python_init_logger.warning(f"ADVERTENCIA PYTHON_INIT: No se pudo inicializar Oracle Client (Modo Thick): {e}")
-    python_init_logger.warning("PYTHON_INIT: La aplicación intentará usar el modo Thin de python-oracledb si está disponible o falla.")
+if os.environ.get('ORACLE_THICK', '0').lower() in ('1', 'true'):
+    try:
+        if instant_client_dir_path:
+            python_init_logger.info(f"Intentando inicializar Oracle Client (Modo Thick) desde: {instant_client_dir_path}")
+            oracledb.init_oracle_client(lib_dir=instant_client_dir_path)
+        else:
+            python_init_logger.info("ORACLE_CLIENT_LIB_DIR no configurado. Intentando inicializar Oracle Client (Modo Thick) usando PATH del sistema o configuración por defecto...")
+            oracledb.init_oracle_client()
+        python_init_logger.info(f"Oracle Client (Modo Thick) inicializado exitosamente. Version: {'.'.join(map(str, oracledb.clientversion()))}")
+    except Exception as e:
+        python_init_logger.warning(f"ADVERTENCIA PYTHON_INIT: No se pudo inicializar Oracle Client (Modo Thick): {e}")
+        python_init_logger.warning("PYTHON_INIT: La aplicación usará el modo Thin de python-oracledb.")
+else:
+    python_init_logger.info("PYTHON_INIT: Usando python-oracledb en modo Thin (ORACLE_THICK no activado).")
 
 app = Flask(__name__)
 CORS(app)
@@ -40,32 +53,66 @@ if not app.logger.handlers:
     app.logger.addHandler(flask_handler)
     app.logger.propagate = False
 
-DEBUG_MODE = os.environ.get('DEBUG_MODE', 'true').lower() == 'true'
-DB_USER = os.environ.get("DB_USER", "admin") # Default user for local dev if not set
-DB_PASSWORD = os.environ.get("DB_PASSWORD", "PasswordCafe123") # Default pass for local dev
-DB_DSN = os.environ.get("DB_DSN", "localhost:1521/XEPDB1") # Default DSN for local dev
-TNS_ADMIN = os.environ.get('TNS_ADMIN')
-DB_WALLET_PASSWORD=os.environ.get('123456789f')
+@dataclass(frozen=True)
+class Config:
+    """Configuración leída una sola vez de las variables de entorno al importar el módulo."""
+    debug_mode: bool
+    db_user: str
+    db_password: str
+    db_dsn: str
+    tns_admin: Optional[str]
+    db_wallet_password: Optional[str]
+    pool_max: int
+    pool_timeout: int
+    pool_wait_timeout: int
+    pool_ping_interval: int
+    pool_max_lifetime_session: int
+    stmt_cache_size: int
+    fetch_arraysize: int
+    db_read_dsn: str
+    read_pool_size: int
+    report_cache_ttl: int
+    report_cache_max_entries: int
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            debug_mode=os.environ.get('DEBUG_MODE', 'true').lower() == 'true',
+            db_user=os.environ.get("DB_USER", "admin"), # Default user for local dev if not set
+            db_password=os.environ.get("DB_PASSWORD", "PasswordCafe123"), # Default pass for local dev
+            db_dsn=os.environ.get("DB_DSN", "localhost:1521/XEPDB1"), # Default DSN for local dev
+            tns_admin=os.environ.get('TNS_ADMIN'),
+            db_wallet_password=os.environ.get('DB_WALLET_PASSWORD'),
+            pool_max=int(os.environ.get('DB_POOL_MAX', '10')),
+            pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', '30')),
+            pool_wait_timeout=int(os.environ.get('DB_POOL_WAIT_TIMEOUT', '2000')), # ms
+            pool_ping_interval=int(os.environ.get('DB_POOL_PING_INTERVAL', '60')), # s
+            pool_max_lifetime_session=int(os.environ.get('DB_POOL_MAX_LIFETIME_SESSION', '3600')),
+            stmt_cache_size=int(os.environ.get('DB_STMT_CACHE_SIZE', '50')),
+            fetch_arraysize=int(os.environ.get('DB_FETCH_ARRAYSIZE', '1000')),
+            # Pool de solo lectura para reportes; DB_READ_DSN permite apuntarlo a una standby
+            db_read_dsn=os.environ.get("DB_READ_DSN") or os.environ.get("DB_DSN", "localhost:1521/XEPDB1"),
+            # Por defecto igual que el pool principal (>= hilos por worker); 0 lo desactiva
+            read_pool_size=int(os.environ.get('DB_READ_POOL_SIZE', os.environ.get('DB_POOL_MAX', '10'))),
+            report_cache_ttl=int(os.environ.get('REPORT_CACHE_TTL', '30')), # s; 0 desactiva la cache
+            report_cache_max_entries=int(os.environ.get('REPORT_CACHE_MAX_ENTRIES', '128')),
+        )
 
-POOL_MIN = int(os.environ.get('DB_POOL_MIN', '2'))
-POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
-POOL_INCREMENT = int(os.environ.get('DB_POOL_INCREMENT', '1'))
-POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
-POOL_MAX_LIFETIME_SESSION = int(os.environ.get('DB_POOL_MAX_LIFETIME_SESSION', '3600'))
+CONFIG = Config.from_env()
 
-if DEBUG_MODE:
+if CONFIG.debug_mode:
     app.logger.info("=== MODO DEBUG ACTIVADO (Variables de Entorno) ===")
-    app.logger.info(f"TNS_ADMIN: {TNS_ADMIN}")
-    app.logger.info(f"DB_USER: {DB_USER}")
-    app.logger.info(f"DB_DSN: {DB_DSN}")
-    app.logger.info(f"DB_PASSWORD configurada: {'Sí' if DB_PASSWORD else 'No'}")
+    app.logger.info(f"TNS_ADMIN: {CONFIG.tns_admin}")
+    app.logger.info(f"DB_USER: {CONFIG.db_user}")
+    app.logger.info(f"DB_DSN: {CONFIG.db_dsn}")
+    app.logger.info(f"DB_PASSWORD configurada: {'Sí' if CONFIG.db_password else 'No'}")
 
 
 def validate_config():
     missing = []
-    if not DB_USER: missing.append("DB_USER")
-    if not DB_PASSWORD: missing.append("DB_PASSWORD")
-    if not DB_DSN: missing.append("DB_DSN")
+    if not CONFIG.db_user: missing.append("DB_USER")
+    if not CONFIG.db_password: missing.append("DB_PASSWORD")
+    if not CONFIG.db_dsn: missing.append("DB_DSN")
     if missing:
         error_msg = f"Variables de entorno faltantes para la conexión a DB: {', '.join(missing)}"
         app.logger.critical(error_msg)
@@ -78,15 +125,47 @@ if not config_valid:
 
 pool = None
 pool_error = None
+read_pool = None
 
 def _output_type_handler_varchar_strip(cursor, name, default_type, size, precision, scale):
     if default_type == oracledb.DB_TYPE_VARCHAR:
         return cursor.var(str, arraysize=cursor.arraysize, outconverter=lambda v: v.strip() if v is not None else None)
+    if default_type == oracledb.DB_TYPE_CLOB:
+        # CLOB como texto en el mismo fetch: un locator obligaría a otro viaje a la BD para leerlo
+        return cursor.var(oracledb.DB_TYPE_LONG, arraysize=cursor.arraysize)
     return None
 
 def _session_callback_set_handlers(conn, requested_tag):
-    # conn.outputtypehandler = _output_type_handler_varchar_strip # Se aplica por conexión ahora
-    pass
+    # Solo se invoca para sesiones nuevas del pool: el handler queda fijado en la sesión y no hace falta reasignarlo en cada acquire()
+    conn.outputtypehandler = _output_type_handler_varchar_strip
+
+def _precalentar_pool(pool_a_calentar, tamano):
+    # Adquiere y libera todas las sesiones para que estén abiertas antes de la primera petición
+    conexiones = []
+    try:
+        for _ in range(tamano):
+            conexiones.append(pool_a_calentar.acquire())
+    except Exception as e:
+        app.logger.warning(f"CREATE_POOL_FUNC: Precalentamiento incompleto del pool ({len(conexiones)}/{tamano}): {e}")
+    finally:
+        for conexion in conexiones:
+            pool_a_calentar.release(conexion)
+
+def _crear_pool(dsn, tamano, **extra):
+    return oracledb.create_pool(
+        user=CONFIG.db_user, password=CONFIG.db_password, dsn=dsn,
+        # Pool de tamaño fijo: sin crecimiento a mitad de una petición; si está lleno se espera como máximo
+        # wait_timeout (TIMEDWAIT: con WAIT, wait_timeout se ignora y acquire() espera sin límite)
+        min=tamano, max=tamano, increment=0,
+        getmode=oracledb.POOL_GETMODE_TIMEDWAIT, wait_timeout=CONFIG.pool_wait_timeout,
+        ping_interval=CONFIG.pool_ping_interval,
+        timeout=CONFIG.pool_timeout,
+        max_lifetime_session=CONFIG.pool_max_lifetime_session,
+        stmtcachesize=CONFIG.stmt_cache_size,
+        homogeneous=True,
+        session_callback=_session_callback_set_handlers,
+        **extra,
+    )
 
 def create_connection_pool():
     global pool, pool_error
@@ -96,137 +175,353 @@ def create_connection_pool():
         return False
 
     try:
-        app.logger.info(f"CREATE_POOL_FUNC: Creando pool de conexiones a Oracle. DSN='{DB_DSN}', User='{DB_USER}'")
-        app.logger.info(f"CREATE_POOL_FUNC: Configuración del pool: min={POOL_MIN}, max={POOL_MAX}, increment={POOL_INCREMENT}, timeout={POOL_TIMEOUT}, max_lifetime_session={POOL_MAX_LIFETIME_SESSION}")
+        app.logger.info(f"CREATE_POOL_FUNC: Creando pool de conexiones a Oracle. DSN='{CONFIG.db_dsn}', User='{CONFIG.db_user}'")
+        app.logger.info(f"CREATE_POOL_FUNC: Configuración del pool (tamaño fijo): min=max={CONFIG.pool_max}, timeout={CONFIG.pool_timeout}, wait_timeout={CONFIG.pool_wait_timeout}ms, ping_interval={CONFIG.pool_ping_interval}s, max_lifetime_session={CONFIG.pool_max_lifetime_session}, stmtcachesize={CONFIG.stmt_cache_size}")
 
        # params = {}
-       # if TNS_ADMIN:
-       #     params["config_dir"] = TNS_ADMIN
-       #     params["wallet_location"] = TNS_ADMIN
-       #     if DB_WALLET_PASSWORD:
-       #         params["wallet_password"] = DB_WALLET_PASSWORD
-
-        pool = oracledb.create_pool(
-            user=DB_USER, password=DB_PASSWORD, dsn=DB_DSN,
-            min=POOL_MIN, max=POOL_MAX, increment=POOL_INCREMENT,
-            timeout=POOL_TIMEOUT,
-            max_lifetime_session=POOL_MAX_LIFETIME_SESSION,
-            session_callback=_session_callback_set_handlers,
+       # if CONFIG.tns_admin:
+       #     params["config_dir"] = CONFIG.tns_admin
+       #     params["wallet_location"] = CONFIG.tns_admin
+       #     if CONFIG.db_wallet_password:
+       #         params["wallet_password"] = CONFIG.db_wallet_password
 
-        )
+        pool = _crear_pool(CONFIG.db_dsn, CONFIG.pool_max)
         app.logger.info(f"CREATE_POOL_FUNC: Pool creado exitosamente.")
         pool_error = None
+        _precalentar_pool(pool, CONFIG.pool_max)
         return True
     except oracledb.DatabaseError as e:
         error_obj, = e.args
         error_msg = f"Error de Oracle al crear pool: {error_obj.message} (Code: {error_obj.code}, Offset: {error_obj.offset})"
-        app.logger.error(f"CREATE_POOL_FUNC: {error_msg}")
-        if DEBUG_MODE: app.logger.error(traceback.format_exc())
+        app.logger.error("CREATE_POOL_FUNC: %s", error_msg, exc_info=CONFIG.debug_mode)
         pool_error = error_msg
         return False
     except Exception as e:
         error_msg = f"Error inesperado al crear pool: {e}"
-        app.logger.error(f"CREATE_POOL_FUNC: {error_msg}")
-        if DEBUG_MODE: app.logger.error(traceback.format_exc())
+        app.logger.error("CREATE_POOL_FUNC: %s", error_msg, exc_info=CONFIG.debug_mode)
         pool_error = error_msg
         return False
 
+def create_read_pool():
+    """Pool separado para los reportes (solo SELECT), con su propia clase de conexión para DRCP.
+
+    Si no se puede crear, los reportes siguen usando el pool principal.
+    """
+    global read_pool
+    if CONFIG.read_pool_size <= 0:
+        return False
+    try:
+        app.logger.info(f"CREATE_POOL_FUNC: Creando pool de lectura. DSN='{CONFIG.db_read_dsn}', tamaño={CONFIG.read_pool_size}")
+        read_pool = _crear_pool(CONFIG.db_read_dsn, CONFIG.read_pool_size, cclass="SGIC_RO")
+        _precalentar_pool(read_pool, CONFIG.read_pool_size)
+        return True
+    except Exception as e:
+        app.logger.warning("CREATE_POOL_FUNC: Pool de lectura no disponible, los reportes usarán el pool principal: %s", e)
+        return False
+
 if config_valid:
     create_connection_pool()
+    create_read_pool()
 else:
     pool_error = "Configuración de DB inválida, no se intentó crear el pool."
     app.logger.error(pool_error)
 
 @contextmanager
-def get_db_connection():
-    if not pool:
-        current_error_msg = pool_error if pool_error else config_msg if not config_valid else "Pool no inicializado por razón desconocida."
-        app.logger.error(f"GET_DB_CONNECTION: Pool no disponible. Error: {current_error_msg}")
-        raise Exception(f"Pool de conexiones no disponible: {current_error_msg}")
-
+def _conexion_de_pool(pool_origen, autocommit):
     connection = None
     try:
-        connection = pool.acquire()
-        connection.outputtypehandler = _output_type_handler_varchar_strip
+        connection = pool_origen.acquire()
+        # Se fija siempre: autocommit pertenece a la sesión y persiste entre adquisiciones del pool
+        connection.autocommit = autocommit
         yield connection
     except oracledb.DatabaseError as e:
         error_obj, = e.args
-        app.logger.error(f"GET_DB_CONNECTION: Error de Oracle adquiriendo/usando conexión: {error_obj.message}")
+        app.logger.error("GET_DB_CONNECTION: Error de Oracle adquiriendo/usando conexión: %s", error_obj.message)
         raise
     except Exception as e:
-        app.logger.error(f"GET_DB_CONNECTION: Error genérico adquiriendo/usando conexión: {e}")
+        app.logger.error("GET_DB_CONNECTION: Error genérico adquiriendo/usando conexión: %s", e)
         raise
     finally:
         if connection:
             try:
-                pool.release(connection)
+                pool_origen.release(connection)
             except Exception as rel_e:
-                app.logger.error(f"GET_DB_CONNECTION: Error liberando conexión: {rel_e}")
-
-def _row_to_dict(cursor, row):
-    if row is None: return None
-    column_names = [d[0].lower() for d in cursor.description]
-    return dict(zip(column_names, row))
-
-def convert_data_types(obj):
-    if isinstance(obj, dict):
-        return {key: convert_data_types(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_data_types(item) for item in obj]
-    elif isinstance(obj, Decimal):
-        # Convertir a float solo si no tiene más de 2-3 decimales o si es para JSON directo
-        # Para cálculos internos, mantener Decimal. Para JSON, float está bien.
+                app.logger.error("GET_DB_CONNECTION: Error liberando conexión: %s", rel_e)
+
+def _verificar_pool_principal():
+    if not pool:
+        current_error_msg = pool_error if pool_error else config_msg if not config_valid else "Pool no inicializado por razón desconocida."
+        app.logger.error("GET_DB_CONNECTION: Pool no disponible. Error: %s", current_error_msg)
+        raise Exception(f"Pool de conexiones no disponible: {current_error_msg}")
+
+def get_db_connection(autocommit=False):
+    _verificar_pool_principal()
+    return _conexion_de_pool(pool, autocommit)
+
+def get_read_connection():
+    """Conexión para reportes de solo lectura: del pool de lectura si existe, si no del principal."""
+    if read_pool:
+        return _conexion_de_pool(read_pool, autocommit=False)
+    _verificar_pool_principal()
+    return _conexion_de_pool(pool, autocommit=False)
+
+def _ajustar_cursor_listado(cursor):
+    """Para listados grandes: menos viajes de fetch a la BD. Debe llamarse antes de execute()."""
+    cursor.arraysize = CONFIG.fetch_arraysize
+    cursor.prefetchrows = CONFIG.fetch_arraysize + 1
+
+# Nombres de columna (en minúsculas) por texto SQL: son los mismos en cada ejecución de la misma sentencia
+_col_cache = {}
+
+def _execute_dict(cursor, sql, params=None):
+    """Ejecuta la sentencia y deja el cursor entregando dicts, sin recalcular los nombres de columna."""
+    cursor.execute(sql, params or {})
+    column_names = _col_cache.get(sql)
+    if column_names is None:
+        column_names = _col_cache.setdefault(sql, tuple(d[0].lower() for d in cursor.description))
+    cursor.rowfactory = lambda *args: dict(zip(column_names, args))
+
+# Columnas devueltas con RETURNING ... INTO para no releer la fila tras un INSERT/UPDATE
+_COLUMNAS_INGREDIENTE = (
+    ("id_ingrediente", int), ("nombre", oracledb.DB_TYPE_VARCHAR),
+    ("descripcion", oracledb.DB_TYPE_VARCHAR), ("unidad_medida", oracledb.DB_TYPE_VARCHAR),
+    ("stock_actual", oracledb.DB_TYPE_NUMBER), ("stock_minimo", oracledb.DB_TYPE_NUMBER),
+    ("fecha_creacion", oracledb.DB_TYPE_TIMESTAMP), ("fecha_actualizacion", oracledb.DB_TYPE_TIMESTAMP),
+)
+_COLUMNAS_PRODUCTO = (
+    ("id_producto", int), ("nombre", oracledb.DB_TYPE_VARCHAR),
+    ("descripcion", oracledb.DB_TYPE_VARCHAR), ("precio_venta", oracledb.DB_TYPE_NUMBER),
+    ("categoria", oracledb.DB_TYPE_VARCHAR),
+    ("fecha_creacion", oracledb.DB_TYPE_TIMESTAMP), ("fecha_actualizacion", oracledb.DB_TYPE_TIMESTAMP),
+)
+
+def _clausula_returning(columnas):
+    nombres = [nombre for nombre, _ in columnas]
+    return f"RETURNING {', '.join(nombres)} INTO {', '.join(':o_' + nombre for nombre in nombres)}"
+
+_RETURNING_INGREDIENTE = _clausula_returning(_COLUMNAS_INGREDIENTE)
+_RETURNING_PRODUCTO = _clausula_returning(_COLUMNAS_PRODUCTO)
+
+def _variables_returning(cursor, columnas):
+    return {f"o_{nombre}": cursor.var(tipo) for nombre, tipo in columnas}
+
+def _dict_returning(variables, columnas, en_plsql=False):
+    # En DML el RETURNING llena un arreglo por fila; dentro de un bloque PL/SQL la variable es escalar
+    if en_plsql:
+        return {nombre: variables[f"o_{nombre}"].getvalue() for nombre, _ in columnas}
+    return {nombre: variables[f"o_{nombre}"].getvalue()[0] for nombre, _ in columnas}
+
+def _orjson_default(obj):
+    # orjson serializa datetime/date de forma nativa; solo Decimal necesita conversión
+    if isinstance(obj, Decimal):
         return float(obj)
-    elif isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    else:
-        return obj
+    raise TypeError(f"Tipo no serializable a JSON: {type(obj).__name__}")
+
+def _json_response(payload, status=200):
+    return app.response_class(orjson.dumps(payload, default=_orjson_default),
+                              status=status, mimetype='application/json')
+
+def _respuesta_streaming(recursos, trozos, mimetype):
+    """Respuesta que envía los trozos (bytes) a medida que se generan.
+
+    `recursos` es un ExitStack con la conexión y el cursor: se cierra cuando termina de enviarse la respuesta.
+    """
+    def generar():
+        try:
+            yield from trozos
+        except Exception as e:
+            app.logger.error("Error generando respuesta en streaming: %s", e, exc_info=CONFIG.debug_mode)
+            raise
+    respuesta = app.response_class(stream_with_context(generar()), mimetype=mimetype)
+    respuesta.call_on_close(recursos.close)
+    return respuesta
+
+def _json_array_stream(recursos, elementos):
+    """Arreglo JSON que se serializa a medida que se leen las filas."""
+    def trozos():
+        yield b'['
+        separador = b''
+        for elemento in elementos:
+            yield separador + orjson.dumps(elemento, default=_orjson_default)
+            separador = b','
+        yield b']'
+    return _respuesta_streaming(recursos, trozos(), 'application/json')
+
+def _ndjson_stream(recursos, elementos):
+    """Un objeto JSON por línea (NDJSON): el cliente puede procesar cada fila sin esperar al final."""
+    trozos = (orjson.dumps(elemento, default=_orjson_default, option=orjson.OPT_APPEND_NEWLINE) for elemento in elementos)
+    return _respuesta_streaming(recursos, trozos, 'application/x-ndjson')
+
+# Cache LRU con TTL para reportes de ventas: guarda el JSON ya serializado. Es por proceso: una escritura
+# solo vacía la cache del worker que la atendió, así que con varios workers de gunicorn los demás pueden
+# servir datos con hasta REPORT_CACHE_TTL segundos de antigüedad. Por eso existencias (stock) no se cachea.
+# Los reportes cacheados solo dependen de las ventas y de los datos del producto vendido, así que solo
+# registrar_salida_por_venta y update_producto invalidan; crear/borrar productos o tocar ingredientes no
+# cambia ningún reporte cacheado.
+_cache_reportes = OrderedDict()
+_cache_reportes_lock = threading.Lock()
+_cache_reportes_generacion = 0
+
+def _invalidar_cache_reportes():
+    global _cache_reportes_generacion
+    with _cache_reportes_lock:
+        _cache_reportes.clear()
+        _cache_reportes_generacion += 1
+
+def _reporte_cacheado(clave, producir):
+    """Respuesta JSON del reporte `clave`, desde la cache si sigue vigente o generada con producir()."""
+    if CONFIG.report_cache_ttl <= 0:
+        return _json_response(producir())
+    ahora = time.monotonic()
+    with _cache_reportes_lock:
+        entrada = _cache_reportes.get(clave)
+        if entrada is not None and entrada[0] > ahora:
+            _cache_reportes.move_to_end(clave)
+            return app.response_class(entrada[1], mimetype='application/json')
+        generacion = _cache_reportes_generacion
+    cuerpo = orjson.dumps(producir(), default=_orjson_default)
+    with _cache_reportes_lock:
+        # Si hubo una escritura mientras se consultaba, el resultado puede estar desactualizado: no se guarda
+        if generacion == _cache_reportes_generacion:
+            _cache_reportes[clave] = (ahora + CONFIG.report_cache_ttl, cuerpo)
+            _cache_reportes.move_to_end(clave)
+            while len(_cache_reportes) > CONFIG.report_cache_max_entries:
+                _cache_reportes.popitem(last=False)
+    return app.response_class(cuerpo, mimetype='application/json')
 
 # --- Funciones de Validación ---
-def validate_ingrediente_data(data, is_update=False):
-    errors = []
-    if not is_update or 'nombre' in data:
-        nombre = data.get('nombre', '').strip()
-        if not nombre: errors.append("El nombre del ingrediente es requerido.")
-        elif len(nombre) > 100: errors.append("El nombre no debe exceder 100 caracteres.")
-
-    if not is_update or 'unidad_medida' in data:
-        unidad = data.get('unidad_medida', '').strip()
-        if not unidad: errors.append("La unidad de medida es requerida.")
-        elif len(unidad) > 50: errors.append("La unidad no debe exceder 50 caracteres.")
+# Límites de las columnas NUMBER y etiquetas de campos, construidos una sola vez al importar
+_STOCK_MAX = Decimal('9999999.999')
+_PRECIO_MAX = Decimal('99999999.99')
+_CANT_MAX = Decimal('99999.999')
+_ETIQUETAS_STOCK = {'stock_actual': 'Stock Actual', 'stock_minimo': 'Stock Minimo'}
+
+# Estructura, tipos y longitudes se validan con esquemas JSON compilados a código Python (fastjsonschema).
+# Los rangos y la precisión de los NUMBER se siguen validando con Decimal más abajo.
+_TEXTO_REQUERIDO = {"type": "string", "pattern": r"\S"}
+_NUMERO = {"type": ["number", "string"]}
+
+_PROPIEDADES_INGREDIENTE = {
+    "nombre": {**_TEXTO_REQUERIDO, "maxLength": 100},
+    "unidad_medida": {**_TEXTO_REQUERIDO, "maxLength": 50},
+    "descripcion": {"type": ["string", "null"], "maxLength": 255},
+    "stock_actual": {"type": ["number", "string", "null"]},
+    "stock_minimo": {"type": ["number", "string", "null"]},
+}
+_PROPIEDADES_PRODUCTO = {
+    "nombre": {**_TEXTO_REQUERIDO, "maxLength": 100},
+    "precio_venta": {"type": ["number", "string", "null"]},
+    "descripcion": {"type": ["string", "null"], "maxLength": 255},
+    "categoria": {"type": ["string", "null"], "maxLength": 100},
+    "ingredientes": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "id_ingrediente": {"type": "integer"},
+                "cantidad_necesaria": _NUMERO,
+                "unidad_medida_receta": {**_TEXTO_REQUERIDO, "maxLength": 50},
+            },
+            "required": ["id_ingrediente", "cantidad_necesaria", "unidad_medida_receta"],
+        },
+    },
+}
+
+_validar_esquema_ingrediente = fastjsonschema.compile(
+    {"type": "object", "properties": _PROPIEDADES_INGREDIENTE, "required": ["nombre", "unidad_medida"]})
+_validar_esquema_ingrediente_update = fastjsonschema.compile(
+    {"type": "object", "properties": _PROPIEDADES_INGREDIENTE})
+_validar_esquema_producto = fastjsonschema.compile(
+    {"type": "object", "properties": _PROPIEDADES_PRODUCTO, "required": ["nombre", "precio_venta"]})
+_validar_esquema_producto_update = fastjsonschema.compile(
+    {"type": "object", "properties": _PROPIEDADES_PRODUCTO})
+
+# Mensajes en español para los errores de esquema, por campo y regla de fastjsonschema.
+# 'pattern' (texto en blanco) se informa igual que 'required'. {n} es la posición en la receta.
+_MENSAJES_ESQUEMA_INGREDIENTE = {
+    "nombre": {"required": "El nombre del ingrediente es requerido.", "maxLength": "El nombre no debe exceder 100 caracteres.",
+               "type": "El nombre del ingrediente debe ser texto."},
+    "unidad_medida": {"required": "La unidad de medida es requerida.", "maxLength": "La unidad no debe exceder 50 caracteres.",
+                      "type": "La unidad de medida debe ser texto."},
+    "descripcion": {"maxLength": "La descripción no debe exceder 255 caracteres.", "type": "La descripción debe ser texto."},
+    "stock_actual": {"type": "Stock Actual debe ser un número válido."},
+    "stock_minimo": {"type": "Stock Minimo debe ser un número válido."},
+}
+_MENSAJES_ESQUEMA_PRODUCTO = {
+    "nombre": {"required": "El nombre del producto es requerido.", "maxLength": "El nombre del producto no debe exceder 100 caracteres.",
+               "type": "El nombre del producto debe ser texto."},
+    "precio_venta": {"required": "El precio de venta es requerido.", "type": "El precio de venta debe ser un número válido."},
+    "descripcion": {"maxLength": "La descripción del producto no debe exceder 255 caracteres.", "type": "La descripción del producto debe ser texto."},
+    "categoria": {"maxLength": "La categoría del producto no debe exceder 100 caracteres.", "type": "La categoría del producto debe ser texto."},
+    "ingredientes": {"type": "Los ingredientes deben ser una lista."},
+}
+_MENSAJES_ESQUEMA_RECETA = {
+    None: {"type": "El ingrediente #{n} de la receta no es un objeto válido."},
+    "id_ingrediente": {"required": "Falta 'id_ingrediente' para el ingrediente #{n}.", "type": "'id_ingrediente' para #{n} debe ser entero."},
+    "cantidad_necesaria": {"required": "Falta 'cantidad_necesaria' para el ingrediente #{n}.", "type": "'cantidad_necesaria' para #{n} debe ser un número."},
+    "unidad_medida_receta": {"required": "Falta 'unidad_medida_receta' para el ingrediente #{n}.", "type": "'unidad_medida_receta' para #{n} debe ser texto.",
+                             "maxLength": "'unidad_medida_receta' para #{n} no debe exceder 50 caracteres."},
+}
+_RUTA_ITEM_RECETA = re.compile(r"^data\.ingredientes\[(\d+)\](?:\.(\w+))?$")
+
+def _errores_esquema(e, mensajes):
+    """Traduce un JsonSchemaException a los mensajes de validación de la API."""
+    regla = 'required' if e.rule == 'pattern' else e.rule
+    if e.rule == 'required':
+        presentes = e.value if isinstance(e.value, dict) else {}
+        rutas = [f"{e.name}.{campo}" for campo in e.definition['required'] if campo not in presentes]
+    else:
+        rutas = [e.name]
+
+    errores = []
+    for ruta in rutas:
+        item = _RUTA_ITEM_RECETA.match(ruta)
+        if item:
+            plantilla = _MENSAJES_ESQUEMA_RECETA.get(item.group(2), {}).get(regla)
+            mensaje = plantilla.format(n=int(item.group(1)) + 1) if plantilla else None
+        elif ruta == 'data':
+            mensaje = "Los datos enviados deben ser un objeto JSON."
+        else:
+            mensaje = mensajes.get(ruta[len('data.'):], {}).get(regla)
+        errores.append(mensaje or f"Estructura inválida: {e.message}")
+    return errores
 
-    if 'descripcion' in data and data.get('descripcion') is not None:
-        if len(data['descripcion']) > 255: errors.append("La descripción no debe exceder 255 caracteres.")
+def validate_ingrediente_data(data, is_update=False):
+    try:
+        (_validar_esquema_ingrediente_update if is_update else _validar_esquema_ingrediente)(data)
+    except JsonSchemaException as e:
+        return _errores_esquema(e, _MENSAJES_ESQUEMA_INGREDIENTE)
 
-    for field in ['stock_actual', 'stock_minimo']:
+    errors = []
+    for field, label in _ETIQUETAS_STOCK.items():
         if field in data:
             value_str = str(data.get(field, '')).strip() # Usar get para evitar KeyError si el campo falta
             if not value_str and (data.get(field) is not None):
-                 errors.append(f"{field.replace('_', ' ').title()} no puede estar vacío si se incluye.")
+                 errors.append(f"{label} no puede estar vacío si se incluye.")
                  continue
             if data.get(field) is None and not is_update :
-                 errors.append(f"{field.replace('_', ' ').title()} es requerido.")
+                 errors.append(f"{label} es requerido.")
                  continue
             if data.get(field) is not None:
                 try:
                     # Usar Decimal para validar, pero el valor en 'data' puede ser float o str del JSON
                     value = Decimal(str(data[field]))
-                    if value < 0: errors.append(f"{field.replace('_', ' ').title()} no puede ser negativo.")
+                    if value < 0: errors.append(f"{label} no puede ser negativo.")
                     # Ajustar la validación de precisión si es necesario, ej. NUMBER(10,3)
-                    if value.as_tuple().exponent < -3: errors.append(f"{field.replace('_', ' ').title()} excede la precisión decimal permitida (3 decimales).")
-                    if value > Decimal('9999999.999'): errors.append(f"{field.replace('_', ' ').title()} excede el valor máximo.")
+                    if value.as_tuple().exponent < -3: errors.append(f"{label} excede la precisión decimal permitida (3 decimales).")
+                    if value > _STOCK_MAX: errors.append(f"{label} excede el valor máximo.")
 
                 except Exception: # Captura errores de conversión de Decimal también
-                    errors.append(f"{field.replace('_', ' ').title()} debe ser un número válido.")
+                    errors.append(f"{label} debe ser un número válido.")
     return errors
 
 def validate_producto_data(data, is_update=False):
-    errors = []
-    if not is_update or 'nombre' in data:
-        nombre = data.get('nombre', '').strip()
-        if not nombre: errors.append("El nombre del producto es requerido.")
-        elif len(nombre) > 100: errors.append("El nombre del producto no debe exceder 100 caracteres.")
+    try:
+        (_validar_esquema_producto_update if is_update else _validar_esquema_producto)(data)
+    except JsonSchemaException as e:
+        return _errores_esquema(e, _MENSAJES_ESQUEMA_PRODUCTO)
 
+    errors = []
     if not is_update or 'precio_venta' in data:
         precio_str = str(data.get('precio_venta', '')).strip()
         if not precio_str and not is_update:
@@ -237,41 +532,17 @@ def validate_producto_data(data, is_update=False):
             try:
                 precio = Decimal(str(data['precio_venta']))
                 if precio < 0: errors.append("El precio de venta no puede ser negativo.")
-                if precio > Decimal('99999999.99'): errors.append("El precio de venta excede el valor máximo.")
+                if precio > _PRECIO_MAX: errors.append("El precio de venta excede el valor máximo.")
             except Exception: errors.append("El precio de venta debe ser un número válido.")
 
-    if 'descripcion' in data and data.get('descripcion') is not None:
-        if len(data['descripcion']) > 255: errors.append("La descripción del producto no debe exceder 255 caracteres.")
-
-    if 'categoria' in data and data.get('categoria') is not None:
-        if len(data['categoria']) > 100: errors.append("La categoría del producto no debe exceder 100 caracteres.")
-
     if 'ingredientes' in data:
-        if not isinstance(data['ingredientes'], list):
-            errors.append("Los ingredientes deben ser una lista.")
-        else:
-            for idx, item_receta in enumerate(data['ingredientes']):
-                if not isinstance(item_receta, dict):
-                    errors.append(f"El ingrediente #{idx+1} de la receta no es un objeto válido.")
-                    continue
-                if "id_ingrediente" not in item_receta: errors.append(f"Falta 'id_ingrediente' para el ingrediente #{idx+1}.")
-                else:
-                    try: int(item_receta["id_ingrediente"])
-                    except (ValueError, TypeError): errors.append(f"'id_ingrediente' para #{idx+1} debe ser entero.")
-
-                if "cantidad_necesaria" not in item_receta: errors.append(f"Falta 'cantidad_necesaria' para el ingrediente #{idx+1}.")
-                else:
-                    try:
-                        cant = Decimal(str(item_receta["cantidad_necesaria"]))
-                        if cant <= 0: errors.append(f"'cantidad_necesaria' para #{idx+1} debe ser positiva.")
-                        if cant.as_tuple().exponent < -3: errors.append(f"'cantidad_necesaria' para #{idx+1} excede precisión (3 decimales).")
-                        if cant > Decimal('99999.999'): errors.append(f"'cantidad_necesaria' para #{idx+1} excede el máximo.")
-                    except Exception: errors.append(f"'cantidad_necesaria' para #{idx+1} debe ser un número.")
-
-                if "unidad_medida_receta" not in item_receta or not str(item_receta.get("unidad_medida_receta","")).strip():
-                    errors.append(f"Falta 'unidad_medida_receta' para el ingrediente #{idx+1}.")
-                elif len(str(item_receta["unidad_medida_receta"])) > 50:
-                    errors.append(f"'unidad_medida_receta' para #{idx+1} no debe exceder 50 caracteres.")
+        for idx, item_receta in enumerate(data['ingredientes']):
+            try:
+                cant = Decimal(str(item_receta["cantidad_necesaria"]))
+                if cant <= 0: errors.append(f"'cantidad_necesaria' para #{idx+1} debe ser positiva.")
+                if cant.as_tuple().exponent < -3: errors.append(f"'cantidad_necesaria' para #{idx+1} excede precisión (3 decimales).")
+                if cant > _CANT_MAX: errors.append(f"'cantidad_necesaria' para #{idx+1} excede el máximo.")
+            except Exception: errors.append(f"'cantidad_necesaria' para #{idx+1} debe ser un número.")
     elif not is_update:
         data['ingredientes'] = []
     return errors
@@ -282,12 +553,13 @@ def get_all_ingredientes():
     try:
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
+                _ajustar_cursor_listado(cursor)
                 sql = "SELECT * FROM SGIC_INGREDIENTES ORDER BY nombre"
-                cursor.execute(sql)
-                ingredientes = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
-                return jsonify(convert_data_types(ingredientes))
+                _execute_dict(cursor, sql)
+                ingredientes = list(cursor)
+                return _json_response(ingredientes)
     except Exception as e:
-        app.logger.error(f"Error obteniendo ingredientes: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error obteniendo ingredientes: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor", "detalle": str(e)}), 500
 
 @app.route('/api/ingredientes/<int:ingrediente_id>', methods=['GET'])
@@ -296,12 +568,12 @@ def get_ingrediente_by_id(ingrediente_id):
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
                 sql = "SELECT * FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id"
-                cursor.execute(sql, {"id": ingrediente_id})
-                ingrediente = _row_to_dict(cursor, cursor.fetchone())
+                _execute_dict(cursor, sql, {"id": ingrediente_id})
+                ingrediente = cursor.fetchone()
                 if not ingrediente: return jsonify({"error": "Ingrediente no encontrado"}), 404
-                return jsonify(convert_data_types(ingrediente))
+                return _json_response(ingrediente)
     except Exception as e:
-        app.logger.error(f"Error obteniendo ingrediente {ingrediente_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error obteniendo ingrediente %s: %s", ingrediente_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor", "detalle": str(e)}), 500
 
 @app.route('/api/ingredientes', methods=['POST'])
@@ -314,36 +586,49 @@ def create_ingrediente():
 
         insert_data = {
             'nombre': data['nombre'].strip(),
-            'descripcion': data.get('descripcion', '').strip() or None,
+            'descripcion': (data.get('descripcion') or '').strip() or None,
             'unidad_medida': data['unidad_medida'].strip(),
             'stock_actual': float(Decimal(str(data.get('stock_actual', '0.000')))), # Convertir a float para BD
             'stock_minimo': float(Decimal(str(data.get('stock_minimo', '0.000'))))
         }
-        with get_db_connection() as connection:
+        with get_db_connection(autocommit=True) as connection:
             with connection.cursor() as cursor:
-                sql = """
+                sql = f"""
                     INSERT INTO SGIC_INGREDIENTES (nombre, descripcion, unidad_medida, stock_actual, stock_minimo)
                     VALUES (:nombre, :descripcion, :unidad_medida, :stock_actual, :stock_minimo)
-                    RETURNING id_ingrediente INTO :new_id
+                    {_RETURNING_INGREDIENTE}
                 """
-                new_id_var = cursor.var(oracledb.NUMBER)
-                cursor.execute(sql, {**insert_data, 'new_id': new_id_var})
-                new_id = new_id_var.getvalue()[0]
-                connection.commit()
+                out_vars = _variables_returning(cursor, _COLUMNAS_INGREDIENTE)
+                cursor.execute(sql, {**insert_data, **out_vars})
 
-                cursor.execute("SELECT * FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id", {"id": new_id})
-                ingrediente_creado = _row_to_dict(cursor, cursor.fetchone())
-                return jsonify(convert_data_types(ingrediente_creado)), 201
+                ingrediente_creado = _dict_returning(out_vars, _COLUMNAS_INGREDIENTE)
+                return _json_response(ingrediente_creado, 201)
     except oracledb.IntegrityError as e:
         error_obj, = e.args
-        app.logger.warning(f"Error de integridad al crear ingrediente: {error_obj.message}")
+        app.logger.warning("Error de integridad al crear ingrediente: %s", error_obj.message)
         if error_obj.code == 1:
             return jsonify({"error": "El nombre del ingrediente ya existe."}), 409
         return jsonify({"error": "Error de integridad en la base de datos.", "detalle": error_obj.message}), 400
     except Exception as e:
-        app.logger.error(f"Error creando ingrediente: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error creando ingrediente: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
+_CAMPOS_ACTUALIZABLES_INGREDIENTE = ('nombre', 'descripcion', 'unidad_medida', 'stock_actual', 'stock_minimo')
+
+# Un único texto SQL para cualquier combinación de campos: los ausentes llegan como NULL y NVL conserva el valor actual.
+# descripcion admite borrarse (NULL explícito), por eso usa un indicador aparte en lugar de NVL.
+_SQL_UPDATE_INGREDIENTE = f"""
+    UPDATE SGIC_INGREDIENTES SET
+        nombre = NVL(:nombre, nombre),
+        descripcion = CASE WHEN :cambiar_descripcion = 1 THEN :descripcion ELSE descripcion END,
+        unidad_medida = NVL(:unidad_medida, unidad_medida),
+        stock_actual = NVL(:stock_actual, stock_actual),
+        stock_minimo = NVL(:stock_minimo, stock_minimo),
+        fecha_actualizacion = CURRENT_TIMESTAMP
+    WHERE id_ingrediente = :id
+    {_RETURNING_INGREDIENTE}
+"""
+
 @app.route('/api/ingredientes/<int:ingrediente_id>', methods=['PUT'])
 def update_ingrediente(ingrediente_id):
     try:
@@ -352,143 +637,183 @@ def update_ingrediente(ingrediente_id):
         errors = validate_ingrediente_data(data, is_update=True)
         if errors: return jsonify({"error": "Datos inválidos para actualizar.", "detalles": errors}), 400
 
-        with get_db_connection() as connection:
+        with get_db_connection(autocommit=True) as connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id", {"id": ingrediente_id})
-                if cursor.fetchone()[0] == 0: return jsonify({"error": "Ingrediente no encontrado."}), 404
-
-                update_fields = []
-                update_params = {"id": ingrediente_id}
-
-                if 'nombre' in data:
-                    update_fields.append("nombre = :nombre")
-                    update_params['nombre'] = data['nombre'].strip()
-                if 'descripcion' in data:
-                    update_fields.append("descripcion = :descripcion")
-                    update_params['descripcion'] = data.get('descripcion', '').strip() or None
-                if 'unidad_medida' in data:
-                    update_fields.append("unidad_medida = :unidad_medida")
-                    update_params['unidad_medida'] = data['unidad_medida'].strip()
-                if 'stock_actual' in data and data['stock_actual'] is not None:
-                    update_fields.append("stock_actual = :stock_actual")
-                    update_params['stock_actual'] = float(Decimal(str(data['stock_actual'])))
-                if 'stock_minimo' in data and data['stock_minimo'] is not None:
-                    update_fields.append("stock_minimo = :stock_minimo")
-                    update_params['stock_minimo'] = float(Decimal(str(data['stock_minimo'])))
-
-                if not update_fields: return jsonify({"mensaje": "No hay campos para actualizar.", "ingrediente_id": ingrediente_id}), 200
-
-                sql = f"UPDATE SGIC_INGREDIENTES SET {', '.join(update_fields)}, fecha_actualizacion = CURRENT_TIMESTAMP WHERE id_ingrediente = :id"
-                cursor.execute(sql, update_params)
-                connection.commit()
-
-                cursor.execute("SELECT * FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id", {"id": ingrediente_id})
-                ingrediente_actualizado = _row_to_dict(cursor, cursor.fetchone())
-                return jsonify(convert_data_types(ingrediente_actualizado))
+                update_params = {campo: None for campo in _CAMPOS_ACTUALIZABLES_INGREDIENTE}
+                update_params.update(id=ingrediente_id, cambiar_descripcion=0)
+                campos_enviados = 0
+
+                for campo in _CAMPOS_ACTUALIZABLES_INGREDIENTE:
+                    if campo not in data: continue
+                    valor = data[campo]
+                    if campo in ('stock_actual', 'stock_minimo'):
+                        if valor is None: continue
+                        valor = float(Decimal(str(valor)))
+                    elif campo == 'descripcion':
+                        valor = (valor or '').strip() or None
+                    else:
+                        valor = valor.strip()
+                    if campo == 'descripcion': update_params['cambiar_descripcion'] = 1
+                    update_params[campo] = valor
+                    campos_enviados += 1
+
+                if not campos_enviados: return jsonify({"mensaje": "No hay campos para actualizar.", "ingrediente_id": ingrediente_id}), 200
+
+                # Tipos de bind fijos: un NULL no debe cambiar el tipo respecto a un número y forzar otro child cursor
+                cursor.setinputsizes(stock_actual=oracledb.DB_TYPE_NUMBER, stock_minimo=oracledb.DB_TYPE_NUMBER,
+                                     cambiar_descripcion=oracledb.DB_TYPE_NUMBER)
+                out_vars = _variables_returning(cursor, _COLUMNAS_INGREDIENTE)
+                cursor.execute(_SQL_UPDATE_INGREDIENTE, {**update_params, **out_vars})
+                if cursor.rowcount == 0: return jsonify({"error": "Ingrediente no encontrado."}), 404
+
+                ingrediente_actualizado = _dict_returning(out_vars, _COLUMNAS_INGREDIENTE)
+                return _json_response(ingrediente_actualizado)
     except oracledb.IntegrityError as e:
         error_obj, = e.args
-        app.logger.warning(f"Error de integridad al actualizar ingrediente {ingrediente_id}: {error_obj.message}")
+        app.logger.warning("Error de integridad al actualizar ingrediente %s: %s", ingrediente_id, error_obj.message)
         if error_obj.code == 1: return jsonify({"error": "El nombre del ingrediente ya existe para otro registro."}), 409
         return jsonify({"error": "Error de integridad en la base de datos.", "detalle": error_obj.message}), 400
     except Exception as e:
-        app.logger.error(f"Error actualizando ingrediente {ingrediente_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error actualizando ingrediente %s: %s", ingrediente_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
 @app.route('/api/ingredientes/<int:ingrediente_id>', methods=['DELETE'])
 def delete_ingrediente(ingrediente_id):
     try:
-        with get_db_connection() as connection:
+        with get_db_connection(autocommit=True) as connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) FROM SGIC_PRODUCTO_INGREDIENTES WHERE id_ingrediente_fk = :id", {"id": ingrediente_id})
-                if cursor.fetchone()[0] > 0:
-                    return jsonify({"error": "No se puede eliminar: el ingrediente está siendo usado en uno o más productos."}), 409
-
+                # Las FKs de recetas/movimientos rechazan el DELETE (ORA-02292) si el ingrediente está en uso
                 cursor.execute("DELETE FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id", {"id": ingrediente_id})
                 if cursor.rowcount == 0: return jsonify({"error": "Ingrediente no encontrado para eliminar."}), 404
-                connection.commit()
                 return jsonify({"mensaje": "Ingrediente eliminado correctamente."})
     except oracledb.IntegrityError as e:
         error_obj, = e.args
-        app.logger.warning(f"Error de integridad al eliminar ingrediente {ingrediente_id}: {error_obj.message}")
+        app.logger.warning("Error de integridad al eliminar ingrediente %s: %s", ingrediente_id, error_obj.message)
+        if error_obj.code == 2292:
+            return jsonify({"error": "No se puede eliminar: el ingrediente está siendo usado en productos o movimientos de inventario.", "detalle": error_obj.message}), 409
         return jsonify({"error": "Error de integridad al eliminar, posiblemente aún en uso en movimientos de inventario u otra tabla.", "detalle": error_obj.message}), 409
     except Exception as e:
-        app.logger.error(f"Error eliminando ingrediente {ingrediente_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error eliminando ingrediente %s: %s", ingrediente_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
 # --- Rutas para Productos ---
 @app.route('/api/productos', methods=['GET'])
 def get_all_productos():
+    # La conexión queda abierta mientras se envía la respuesta; _json_array_stream la libera al terminar
+    recursos = ExitStack()
     try:
-        with get_db_connection() as connection:
-            productos_completos = []
-            with connection.cursor() as cursor_prod:
-                cursor_prod.execute("SELECT * FROM SGIC_PRODUCTOS ORDER BY nombre")
-                productos_base = [_row_to_dict(cursor_prod, row) for row in cursor_prod.fetchall()]
-
-            if not productos_base: return jsonify([])
-
-            for prod_dict_base in productos_base:
-                prod_dict = convert_data_types(prod_dict_base.copy())
-                with connection.cursor() as cursor_ing:
-                    cursor_ing.execute("""
-                        SELECT pi.id_ingrediente_fk, i.nombre as nombre_ingrediente, pi.cantidad_necesaria, pi.unidad_medida_receta
-                        FROM SGIC_PRODUCTO_INGREDIENTES pi
-                        JOIN SGIC_INGREDIENTES i ON pi.id_ingrediente_fk = i.id_ingrediente
-                        WHERE pi.id_producto_fk = :id_prod ORDER BY i.nombre
-                    """, {'id_prod': prod_dict["id_producto"]})
-
-                    ingredientes_receta = []
-                    for ing_row_tuple in cursor_ing:
-                        ing_dict_raw = _row_to_dict(cursor_ing, ing_row_tuple)
-                        if ing_dict_raw:
-                            ingredientes_receta.append({
-                                "id_ingrediente": ing_dict_raw["id_ingrediente_fk"],
-                                "nombre_ingrediente": ing_dict_raw["nombre_ingrediente"],
-                                "cantidad_necesaria": ing_dict_raw["cantidad_necesaria"], # Ya es Decimal o float
-                                "unidad_medida_receta": ing_dict_raw["unidad_medida_receta"]
-                            })
-                    prod_dict["ingredientes"] = convert_data_types(ingredientes_receta)
-                productos_completos.append(prod_dict)
-            return jsonify(productos_completos)
+        connection = recursos.enter_context(get_db_connection())
+        cursor = recursos.enter_context(connection.cursor())
+        _ajustar_cursor_listado(cursor)
+        # Una sola consulta para productos y recetas (evita una consulta de ingredientes por producto)
+        _execute_dict(cursor, """
+            SELECT p.*, pi.id_ingrediente_fk, i.nombre as nombre_ingrediente, pi.cantidad_necesaria, pi.unidad_medida_receta
+            FROM SGIC_PRODUCTOS p
+            LEFT JOIN SGIC_PRODUCTO_INGREDIENTES pi ON pi.id_producto_fk = p.id_producto
+            LEFT JOIN SGIC_INGREDIENTES i ON i.id_ingrediente = pi.id_ingrediente_fk
+            ORDER BY p.nombre, p.id_producto, i.nombre
+        """)
+        return _json_array_stream(recursos, _agrupar_productos(cursor))
     except Exception as e:
-        app.logger.error(f"Error obteniendo productos: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        recursos.close()
+        app.logger.error("Error obteniendo productos: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor al obtener productos.", "detalle": str(e)}), 500
 
+def _agrupar_productos(cursor):
+    """Entrega cada producto con su receta en cuanto se leen todas sus filas (vienen contiguas por el ORDER BY)."""
+    prod_dict = None
+    for fila in cursor:
+        id_ingrediente = fila.pop("id_ingrediente_fk")
+        nombre_ingrediente = fila.pop("nombre_ingrediente")
+        cantidad_necesaria = fila.pop("cantidad_necesaria")
+        unidad_medida_receta = fila.pop("unidad_medida_receta")
+        # Se reutiliza el dict de la primera fila de cada producto; las demás solo aportan su ingrediente
+        if prod_dict is None or prod_dict["id_producto"] != fila["id_producto"]:
+            if prod_dict is not None:
+                yield prod_dict
+            prod_dict = fila
+            prod_dict["ingredientes"] = []
+        if id_ingrediente is not None:
+            prod_dict["ingredientes"].append({
+                "id_ingrediente": id_ingrediente,
+                "nombre_ingrediente": nombre_ingrediente,
+                "cantidad_necesaria": cantidad_necesaria,
+                "unidad_medida_receta": unidad_medida_receta
+            })
+    if prod_dict is not None:
+        yield prod_dict
+
 @app.route('/api/productos/<int:producto_id>', methods=['GET'])
 def get_producto_by_id(producto_id):
     try:
         with get_db_connection() as connection:
-            producto_dict = None
             with connection.cursor() as cursor:
-                cursor.execute("SELECT * FROM SGIC_PRODUCTOS WHERE id_producto = :id", {"id": producto_id})
-                producto_dict_base = _row_to_dict(cursor, cursor.fetchone())
-
-            if not producto_dict_base: return jsonify({"error": "Producto no encontrado."}), 404
-
-            producto_dict = convert_data_types(producto_dict_base.copy())
-
-            with connection.cursor() as cursor_ing:
-                cursor_ing.execute("""
-                    SELECT pi.id_ingrediente_fk, i.nombre as nombre_ingrediente, pi.cantidad_necesaria, pi.unidad_medida_receta
-                    FROM SGIC_PRODUCTO_INGREDIENTES pi JOIN SGIC_INGREDIENTES i ON pi.id_ingrediente_fk = i.id_ingrediente
-                    WHERE pi.id_producto_fk = :id_prod ORDER BY i.nombre
-                """, {'id_prod': producto_id})
-                ingredientes_receta = []
-                for ing_row_tuple in cursor_ing:
-                    ing_dict_raw = _row_to_dict(cursor_ing, ing_row_tuple)
-                    if ing_dict_raw:
-                        ingredientes_receta.append({
-                           "id_ingrediente": ing_dict_raw["id_ingrediente_fk"],
-                           "nombre_ingrediente": ing_dict_raw["nombre_ingrediente"],
-                           "cantidad_necesaria": ing_dict_raw["cantidad_necesaria"],
-                           "unidad_medida_receta": ing_dict_raw["unidad_medida_receta"]
-                        })
-                producto_dict["ingredientes"] = convert_data_types(ingredientes_receta)
-            return jsonify(producto_dict)
+                # Oracle arma el JSON del producto con su receta en un solo viaje a la BD
+                cursor.execute("""
+                    SELECT JSON_OBJECT(
+                        'id_producto' VALUE p.id_producto,
+                        'nombre' VALUE p.nombre,
+                        'descripcion' VALUE p.descripcion,
+                        'precio_venta' VALUE p.precio_venta,
+                        'categoria' VALUE p.categoria,
+                        'fecha_creacion' VALUE p.fecha_creacion,
+                        'fecha_actualizacion' VALUE p.fecha_actualizacion,
+                        'ingredientes' VALUE NVL((
+                            SELECT JSON_ARRAYAGG(JSON_OBJECT(
+                                       'id_ingrediente' VALUE pi.id_ingrediente_fk,
+                                       'nombre_ingrediente' VALUE i.nombre,
+                                       'cantidad_necesaria' VALUE pi.cantidad_necesaria,
+                                       'unidad_medida_receta' VALUE pi.unidad_medida_receta
+                                   ) ORDER BY i.nombre RETURNING CLOB)
+                            FROM SGIC_PRODUCTO_INGREDIENTES pi JOIN SGIC_INGREDIENTES i ON pi.id_ingrediente_fk = i.id_ingrediente
+                            WHERE pi.id_producto_fk = p.id_producto
+                        ), '[]') FORMAT JSON
+                        RETURNING CLOB)
+                    FROM SGIC_PRODUCTOS p WHERE p.id_producto = :id
+                """, {"id": producto_id})
+                row = cursor.fetchone()
+                if not row: return jsonify({"error": "Producto no encontrado."}), 404
+                return app.response_class(row[0], mimetype='application/json')
     except Exception as e:
-        app.logger.error(f"Error obteniendo producto {producto_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error obteniendo producto %s: %s", producto_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
+_SQL_INSERT_PRODUCTO = f"""
+    INSERT INTO SGIC_PRODUCTOS (nombre, descripcion, precio_venta, categoria)
+    VALUES (:nombre, :descripcion, :precio_venta, :categoria) {_RETURNING_PRODUCTO}
+"""
+
+# Producto + receta en un solo viaje: se valida que existan los ingredientes, se inserta el producto
+# y la receta con FORALL. Si falta un ingrediente se devuelve su ID en :id_faltante sin insertar nada.
+_PLSQL_CREAR_PRODUCTO_CON_RECETA = f"""
+    DECLARE
+        TYPE t_numeros IS TABLE OF NUMBER INDEX BY BINARY_INTEGER;
+        TYPE t_textos IS TABLE OF VARCHAR2(50) INDEX BY BINARY_INTEGER;
+        v_ids t_numeros := :ids_ingredientes;
+        v_cantidades t_numeros := :cantidades;
+        v_unidades t_textos := :unidades;
+        v_existe NUMBER;
+        v_id_producto NUMBER;
+    BEGIN
+        FOR i IN 1 .. v_ids.COUNT LOOP
+            SELECT COUNT(*) INTO v_existe FROM DUAL
+            WHERE EXISTS (SELECT 1 FROM SGIC_INGREDIENTES WHERE id_ingrediente = v_ids(i));
+            IF v_existe = 0 THEN
+                :id_faltante := v_ids(i);
+                RETURN;
+            END IF;
+        END LOOP;
+
+        INSERT INTO SGIC_PRODUCTOS (nombre, descripcion, precio_venta, categoria)
+        VALUES (:nombre, :descripcion, :precio_venta, :categoria) {_RETURNING_PRODUCTO};
+        v_id_producto := :o_id_producto;
+
+        FORALL i IN 1 .. v_ids.COUNT
+            INSERT INTO SGIC_PRODUCTO_INGREDIENTES (id_producto_fk, id_ingrediente_fk, cantidad_necesaria, unidad_medida_receta)
+            VALUES (v_id_producto, v_ids(i), v_cantidades(i), v_unidades(i));
+    END;
+"""
+
 @app.route('/api/productos', methods=['POST'])
 def create_producto():
     try:
@@ -497,57 +822,62 @@ def create_producto():
         errors = validate_producto_data(data)
         if errors: return jsonify({"error": "Datos de producto inválidos.", "detalles": errors}), 400
 
-        with get_db_connection() as connection:
+        params_prod = {
+            'nombre': data['nombre'].strip(),
+            'descripcion': (data.get('descripcion') or '').strip() or None,
+            'precio_venta': float(Decimal(str(data['precio_venta']))),
+            'categoria': (data.get('categoria') or '').strip() or None,
+        }
+        receta = data.get('ingredientes')
+
+        # autocommit: tanto el INSERT simple como el bloque PL/SQL se confirman en el mismo viaje
+        with get_db_connection(autocommit=True) as connection:
             with connection.cursor() as cursor:
-                sql_prod = """
-                    INSERT INTO SGIC_PRODUCTOS (nombre, descripcion, precio_venta, categoria)
-                    VALUES (:nombre, :descripcion, :precio_venta, :categoria) RETURNING id_producto INTO :new_prod_id
-                """
-                new_prod_id_var = cursor.var(oracledb.NUMBER)
-                cursor.execute(sql_prod, {
-                    'nombre': data['nombre'].strip(),
-                    'descripcion': data.get('descripcion', '').strip() or None,
-                    'precio_venta': float(Decimal(str(data['precio_venta']))),
-                    'categoria': data.get('categoria', '').strip() or None,
-                    'new_prod_id': new_prod_id_var
+                out_vars = _variables_returning(cursor, _COLUMNAS_PRODUCTO)
+                if not receta:
+                    cursor.execute(_SQL_INSERT_PRODUCTO, {**params_prod, **out_vars})
+                    return _json_response(_dict_returning(out_vars, _COLUMNAS_PRODUCTO), 201)
+
+                id_faltante = cursor.var(int)
+                cursor.execute(_PLSQL_CREAR_PRODUCTO_CON_RECETA, {
+                    **params_prod, **out_vars,
+                    'ids_ingredientes': cursor.arrayvar(oracledb.DB_TYPE_NUMBER, [int(item["id_ingrediente"]) for item in receta]),
+                    'cantidades': cursor.arrayvar(oracledb.DB_TYPE_NUMBER, [float(Decimal(str(item["cantidad_necesaria"]))) for item in receta]),
+                    'unidades': cursor.arrayvar(oracledb.DB_TYPE_VARCHAR, [item["unidad_medida_receta"].strip() for item in receta], 50),
+                    'id_faltante': id_faltante,
                 })
-                new_producto_id = new_prod_id_var.getvalue()[0]
-
-                if data.get('ingredientes'):
-                    for item_receta in data['ingredientes']:
-                        cursor.execute("SELECT COUNT(*) FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id_ing",
-                                       {"id_ing": int(item_receta["id_ingrediente"])})
-                        if cursor.fetchone()[0] == 0:
-                            connection.rollback()
-                            return jsonify({"error": f"El ingrediente con ID {item_receta['id_ingrediente']} no existe."}), 400
-                        cursor.execute("""
-                            INSERT INTO SGIC_PRODUCTO_INGREDIENTES (id_producto_fk, id_ingrediente_fk, cantidad_necesaria, unidad_medida_receta)
-                            VALUES (:id_prod, :id_ing, :cant, :unidad)
-                        """, {
-                            "id_prod": new_producto_id,
-                            "id_ing": int(item_receta["id_ingrediente"]),
-                            "cant": float(Decimal(str(item_receta["cantidad_necesaria"]))),
-                            "unidad": item_receta["unidad_medida_receta"].strip()
-                        })
-                connection.commit()
+                if id_faltante.getvalue() is not None:
+                    return jsonify({"error": f"El ingrediente con ID {id_faltante.getvalue()} no existe."}), 400
 
-                # Releer para devolver el producto completo
-                cursor.execute("SELECT * FROM SGIC_PRODUCTOS WHERE id_producto = :id", {"id": new_producto_id})
-                producto_creado_base = _row_to_dict(cursor, cursor.fetchone())
                 # ... (código para re-leer ingredientes de receta y añadir a producto_creado) ...
-                return jsonify(convert_data_types(producto_creado_base)), 201 # Simplificado, idealmente devolver con receta
+                return _json_response(_dict_returning(out_vars, _COLUMNAS_PRODUCTO, en_plsql=True), 201) # Simplificado, idealmente devolver con receta
     except oracledb.IntegrityError as e:
         error_obj, = e.args
-        app.logger.warning(f"Error de integridad al crear producto: {error_obj.message}")
+        app.logger.warning("Error de integridad al crear producto: %s", error_obj.message)
         if error_obj.code == 1: return jsonify({"error": "El nombre del producto ya existe."}), 409
+        if error_obj.code == 2291: return jsonify({"error": "Alguno de los ingredientes de la receta no existe."}), 400
         return jsonify({"error": "Error de integridad en la base de datos.", "detalle": error_obj.message}), 400
     except ValueError as ve:
-        app.logger.warning(f"Error de valor al crear producto: {ve}")
+        app.logger.warning("Error de valor al crear producto: %s", ve)
         return jsonify({"error": "Datos inválidos.", "detalle": str(ve)}), 400
     except Exception as e:
-        app.logger.error(f"Error creando producto: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error creando producto: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
+_CAMPOS_ACTUALIZABLES_PRODUCTO = ('nombre', 'descripcion', 'precio_venta', 'categoria')
+
+# Mismo patrón que _SQL_UPDATE_INGREDIENTE: texto fijo, NVL para los campos obligatorios
+# e indicador explícito para los opcionales que pueden borrarse.
+_SQL_UPDATE_PRODUCTO = """
+    UPDATE SGIC_PRODUCTOS SET
+        nombre = NVL(:nombre, nombre),
+        descripcion = CASE WHEN :cambiar_descripcion = 1 THEN :descripcion ELSE descripcion END,
+        precio_venta = NVL(:precio_venta, precio_venta),
+        categoria = CASE WHEN :cambiar_categoria = 1 THEN :categoria ELSE categoria END,
+        fecha_actualizacion = CURRENT_TIMESTAMP
+    WHERE id_producto = :id
+"""
+
 @app.route('/api/productos/<int:producto_id>', methods=['PUT'])
 def update_producto(producto_id):
     try:
@@ -556,38 +886,68 @@ def update_producto(producto_id):
         errors = validate_producto_data(data, is_update=True)
         if errors: return jsonify({"error": "Datos de producto inválidos para actualizar.", "detalles": errors}), 400
 
+        update_params_prod = {campo: None for campo in _CAMPOS_ACTUALIZABLES_PRODUCTO}
+        update_params_prod.update(id=producto_id, cambiar_descripcion=0, cambiar_categoria=0)
+        campos_enviados = 0
+        for campo in _CAMPOS_ACTUALIZABLES_PRODUCTO:
+            if campo not in data: continue
+            valor = data[campo]
+            if campo == 'precio_venta':
+                if valor is None: continue
+                valor = float(Decimal(str(valor)))
+            elif campo in ('descripcion', 'categoria'):
+                valor = (valor or '').strip() or None
+                update_params_prod[f'cambiar_{campo}'] = 1
+            else:
+                valor = valor.strip()
+            update_params_prod[campo] = valor
+            campos_enviados += 1
+
+        # Sin nada que modificar no se llega a pedir una conexión al pool
+        if not campos_enviados and 'ingredientes' not in data:
+            return jsonify({"error": "No hay campos para actualizar."}), 400
+
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) FROM SGIC_PRODUCTOS WHERE id_producto = :id", {"id": producto_id})
-                if cursor.fetchone()[0] == 0: return jsonify({"error": "Producto no encontrado."}), 404
-
-                update_fields_prod = []
-                update_params_prod = {"id": producto_id}
-                # ... (construcción de update_fields_prod y update_params_prod) ...
-                if 'nombre' in data: update_fields_prod.append("nombre = :nombre"); update_params_prod['nombre'] = data['nombre'].strip()
-                # ... (otros campos) ...
-                if 'precio_venta' in data and data['precio_venta'] is not None: update_fields_prod.append("precio_venta = :precio_venta"); update_params_prod['precio_venta'] = float(Decimal(str(data['precio_venta'])))
-
-
-                if update_fields_prod:
-                    sql_update_prod = f"UPDATE SGIC_PRODUCTOS SET {', '.join(update_fields_prod)}, fecha_actualizacion = CURRENT_TIMESTAMP WHERE id_producto = :id"
-                    cursor.execute(sql_update_prod, update_params_prod)
+                # El UPDATE se ejecuta siempre (al menos marca fecha_actualizacion) y hace de comprobación de existencia
+                cursor.setinputsizes(precio_venta=oracledb.DB_TYPE_NUMBER, cambiar_descripcion=oracledb.DB_TYPE_NUMBER,
+                                     cambiar_categoria=oracledb.DB_TYPE_NUMBER)
+                cursor.execute(_SQL_UPDATE_PRODUCTO, update_params_prod)
+                if cursor.rowcount == 0: return jsonify({"error": "Producto no encontrado."}), 404
 
                 if 'ingredientes' in data:
+                    # Si la receta nueva falla se vuelve a este punto: los cambios del producto no se pierden
+                    cursor.execute("SAVEPOINT sp_receta")
                     cursor.execute("DELETE FROM SGIC_PRODUCTO_INGREDIENTES WHERE id_producto_fk = :id_prod", {"id_prod": producto_id})
-                    for item_receta in data['ingredientes']:
-                        # ... (verificación de existencia de ingrediente y INSERT) ...
-                        cursor.execute("SELECT COUNT(*) FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id_ing", {"id_ing": int(item_receta["id_ingrediente"])})
-                        if cursor.fetchone()[0] == 0: connection.rollback(); return jsonify({"error": f"Ingrediente ID {item_receta['id_ingrediente']} no existe."}), 400
-                        cursor.execute("INSERT INTO SGIC_PRODUCTO_INGREDIENTES VALUES (:id_prod, :id_ing, :cant, :unidad)", {
-                            "id_prod": producto_id, "id_ing": int(item_receta["id_ingrediente"]),
-                            "cant": float(Decimal(str(item_receta["cantidad_necesaria"]))), "unidad": item_receta["unidad_medida_receta"].strip()
-                        })
+                    if data['ingredientes']:
+                        filas_receta = [(producto_id, int(item_receta["id_ingrediente"]), float(Decimal(str(item_receta["cantidad_necesaria"]))), item_receta["unidad_medida_receta"].strip())
+                                        for item_receta in data['ingredientes']]
+                        # Sin consulta previa de validación: la FK rechaza los ingredientes inexistentes y
+                        # batcherrors indica en qué fila ocurrió cada error
+                        cursor.executemany("""
+                            INSERT INTO SGIC_PRODUCTO_INGREDIENTES (id_producto_fk, id_ingrediente_fk, cantidad_necesaria, unidad_medida_receta)
+                            VALUES (:1, :2, :3, :4)
+                        """, filas_receta, batcherrors=True)
+                        errores_receta = cursor.getbatcherrors()
+                        if errores_receta:
+                            cursor.execute("ROLLBACK TO SAVEPOINT sp_receta")
+                            if campos_enviados:
+                                connection.commit()
+                                _invalidar_cache_reportes()
+                                aviso = "La receta no se modificó; los demás cambios del producto se guardaron."
+                            else:
+                                connection.rollback()
+                                aviso = "La receta no se modificó."
+                            error_receta = errores_receta[0]
+                            if error_receta.code == 2291:
+                                return jsonify({"error": f"Ingrediente ID {filas_receta[error_receta.offset][1]} no existe. {aviso}"}), 400
+                            return jsonify({"error": f"Error de integridad en la receta. {aviso}", "detalle": error_receta.message}), 400
                 connection.commit()
+                _invalidar_cache_reportes()
                 # ... (releer producto actualizado y devolver) ...
                 return jsonify({"mensaje": "Producto actualizado"}), 200 # Simplificado
     except Exception as e:
-        app.logger.error(f"Error actualizando producto {producto_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error actualizando producto %s: %s", producto_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
 @app.route('/api/productos/<int:producto_id>', methods=['DELETE'])
@@ -595,54 +955,59 @@ def delete_producto(producto_id):
     try:
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT COUNT(*) FROM SGIC_PRODUCTOS WHERE id_producto = :id", {"id": producto_id})
-                if cursor.fetchone()[0] == 0: return jsonify({"error": "Producto no encontrado para eliminar."}), 404
                 # ON DELETE CASCADE se encarga de SGIC_PRODUCTO_INGREDIENTES
                 # ON DELETE RESTRICT en SGIC_VENTAS previene borrar si hay ventas. Considerar lógica para esto.
-                cursor.execute("SELECT COUNT(*) FROM SGIC_VENTAS WHERE id_producto_fk = :id", {"id": producto_id})
-                if cursor.fetchone()[0] > 0:
+                # Basta con encontrar una venta: no hace falta contar todas. Para que se resuelva con una sola
+                # lectura de índice, SGIC_VENTAS necesita un índice que empiece por id_producto_fk (Oracle no indexa
+                # las FKs automáticamente); ix_ventas_prod_cov, sugerido junto a _SQL_RANKING_VENTAS, lo cubre.
+                cursor.execute("SELECT 1 FROM SGIC_VENTAS WHERE id_producto_fk = :id FETCH FIRST 1 ROWS ONLY", {"id": producto_id})
+                if cursor.fetchone() is not None:
                     return jsonify({"error": "No se puede eliminar: el producto tiene ventas registradas."}), 409
 
                 cursor.execute("DELETE FROM SGIC_PRODUCTOS WHERE id_producto = :id", {"id": producto_id})
-                if cursor.rowcount == 0: return jsonify({"error": "Producto no encontrado durante intento de eliminación."}), 404
+                if cursor.rowcount == 0: return jsonify({"error": "Producto no encontrado para eliminar."}), 404
                 connection.commit()
                 return jsonify({"mensaje": f"Producto ID {producto_id} eliminado correctamente."})
     except oracledb.IntegrityError as e: # Podría ser por otras FKs no manejadas
         error_obj, = e.args
-        app.logger.warning(f"Error de integridad al eliminar producto {producto_id}: {error_obj.message}")
+        app.logger.warning("Error de integridad al eliminar producto %s: %s", producto_id, error_obj.message)
         return jsonify({"error": "Error de integridad al eliminar el producto.", "detalle": error_obj.message}), 409
     except Exception as e:
-        app.logger.error(f"Error eliminando producto {producto_id}: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error eliminando producto %s: %s", producto_id, e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor.", "detalle": str(e)}), 500
 
 
 # --- Rutas para Movimientos de Inventario ---
-def _actualizar_stock_ingrediente_db(id_ingrediente, cantidad_ajuste_decimal, tipo_movimiento, observacion, cursor, id_venta=None):
+def _actualizar_stock_ingrediente_db(id_ingrediente, cantidad_ajuste, tipo_movimiento, observacion, cursor):
     cursor.execute("SELECT stock_actual, nombre FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id FOR UPDATE", {'id': id_ingrediente})
     ingrediente_row = cursor.fetchone()
     if not ingrediente_row: raise ValueError(f"Ingrediente ID {id_ingrediente} no encontrado.")
 
-    stock_actual_decimal = Decimal(str(ingrediente_row[0]))
-    nombre_ingrediente = ingrediente_row[1]
-
-    nuevo_stock_decimal = stock_actual_decimal + cantidad_ajuste_decimal
-    nuevo_stock_decimal = nuevo_stock_decimal.quantize(Decimal('0.001'), rounding=ROUND_HALF_UP)
+    stock_actual, nombre_ingrediente = ingrediente_row
+    cantidad_ajuste = float(cantidad_ajuste)
 
-    if nuevo_stock_decimal < 0:
-        raise ValueError(f"Stock insuficiente para '{nombre_ingrediente}' (ID {id_ingrediente}). Requiere {abs(cantidad_ajuste_decimal)}, disponible {stock_actual_decimal}.")
+    # Stock en milésimas enteras (la precisión de la columna): stock y ajuste tienen como máximo 3 decimales
+    # (el llamador lo valida), así que round() solo elimina el error de float y la suma es exacta
+    nuevo_stock_milis = round(stock_actual * 1000) + round(cantidad_ajuste * 1000)
+    if nuevo_stock_milis < 0:
+        raise ValueError(f"Stock insuficiente para '{nombre_ingrediente}' (ID {id_ingrediente}). Requiere {abs(cantidad_ajuste)}, disponible {stock_actual}.")
+    nuevo_stock = nuevo_stock_milis / 1000
 
-    cursor.execute("UPDATE SGIC_INGREDIENTES SET stock_actual = :nuevo_stock WHERE id_ingrediente = :id",
-                   {'nuevo_stock': float(nuevo_stock_decimal), 'id': id_ingrediente})
+    out_vars = _variables_returning(cursor, _COLUMNAS_INGREDIENTE)
+    cursor.execute(f"UPDATE SGIC_INGREDIENTES SET stock_actual = :nuevo_stock WHERE id_ingrediente = :id {_RETURNING_INGREDIENTE}",
+                   {'nuevo_stock': nuevo_stock, 'id': id_ingrediente, **out_vars})
 
     cursor.execute("""
         INSERT INTO SGIC_MOVIMIENTOS_INVENTARIO
-        (id_ingrediente_fk, id_venta_fk, tipo_movimiento, cantidad, fecha_movimiento, observacion)
-        VALUES (:id_ing, :id_venta, :tipo, :cant, :fecha, :obs)
+        (id_ingrediente_fk, tipo_movimiento, cantidad, fecha_movimiento, observacion)
+        VALUES (:id_ing, :tipo, :cant, :fecha, :obs)
     """, {
-        "id_ing": id_ingrediente, "id_venta": id_venta, "tipo": tipo_movimiento,
-        "cant": abs(float(cantidad_ajuste_decimal)), "fecha": datetime.now(), "obs": observacion
+        "id_ing": id_ingrediente, "tipo": tipo_movimiento,
+        "cant": abs(cantidad_ajuste), "fecha": datetime.now(), "obs": observacion
     })
-    app.logger.info(f"Movimiento '{tipo_movimiento}' de {abs(cantidad_ajuste_decimal)} para '{nombre_ingrediente}' (Venta ID: {id_venta}). Nuevo stock: {nuevo_stock_decimal}")
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("Movimiento '%s' de %s para '%s'. Nuevo stock: %s", tipo_movimiento, abs(cantidad_ajuste), nombre_ingrediente, nuevo_stock)
+    return _dict_returning(out_vars, _COLUMNAS_INGREDIENTE)
 
 @app.route('/api/inventario/entrada', methods=['POST'])
 def registrar_entrada_inventario():
@@ -653,28 +1018,95 @@ def registrar_entrada_inventario():
         id_ingrediente = int(data['id_ingrediente'])
         cantidad = Decimal(str(data['cantidad']))
         if cantidad <= 0: return jsonify({"error": "La cantidad debe ser positiva."}), 400
+        if cantidad.as_tuple().exponent < -3: return jsonify({"error": "La cantidad excede la precisión decimal permitida (3 decimales)."}), 400
     except (ValueError, TypeError):
         return jsonify({"error": "id_ingrediente y cantidad deben ser números válidos."}), 400
 
     tipo_movimiento = data.get('tipo_movimiento', "ENTRADA_COMPRA").strip().upper()
-    observacion = data.get('observacion', f"Entrada de {cantidad} unidades.")
+    # El texto por defecto solo se arma si el cliente no envió observacion
+    observacion = data['observacion'] if 'observacion' in data else f"Entrada de {cantidad} unidades."
     try:
         with get_db_connection() as connection:
             with connection.cursor() as cursor:
-                _actualizar_stock_ingrediente_db(id_ingrediente, cantidad, tipo_movimiento, observacion, cursor)
+                # La fila actualizada llega por RETURNING: no hace falta releerla con otra conexión
+                ing_actualizado = _actualizar_stock_ingrediente_db(id_ingrediente, cantidad, tipo_movimiento, observacion, cursor)
                 connection.commit()
-
-        with get_db_connection() as conn_read:
-             with conn_read.cursor() as cursor_read:
-                cursor_read.execute("SELECT * FROM SGIC_INGREDIENTES WHERE id_ingrediente = :id", {"id": id_ingrediente})
-                ing_actualizado = _row_to_dict(cursor_read, cursor_read.fetchone())
-        return jsonify({"mensaje": "Entrada registrada y stock actualizado.", "ingrediente_actualizado": convert_data_types(ing_actualizado)})
+        return _json_response({"mensaje": "Entrada registrada y stock actualizado.", "ingrediente_actualizado": ing_actualizado})
     except ValueError as ve:
         return jsonify({"error": str(ve)}), 400
     except Exception as e:
-        app.logger.error(f"Error registrando entrada: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error registrando entrada: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor", "detalle": str(e)}), 500
 
+# Errores de negocio lanzados con RAISE_APPLICATION_ERROR desde los bloques PL/SQL
+_ORA_STOCK_INSUFICIENTE = 20001
+_ORA_PRODUCTO_NO_ENCONTRADO = 20002
+
+def _mensaje_error_aplicacion(error_obj):
+    """Texto de un RAISE_APPLICATION_ERROR sin el prefijo 'ORA-2000x: ' ni la pila de ORA-06512."""
+    return error_obj.message.split('\n', 1)[0].split(': ', 1)[-1]
+
+# Venta completa en un solo viaje: producto, INSERT de la venta, receta bloqueada FOR UPDATE,
+# validación de stock y descuento + movimientos con FORALL. Ante cualquier error el bloque entero se deshace.
+_PLSQL_REGISTRAR_VENTA = """
+    DECLARE
+        TYPE t_numeros IS TABLE OF NUMBER INDEX BY PLS_INTEGER;
+        TYPE t_nombres IS TABLE OF SGIC_INGREDIENTES.nombre%TYPE INDEX BY PLS_INTEGER;
+        v_nombre SGIC_PRODUCTOS.nombre%TYPE;
+        v_precio SGIC_PRODUCTOS.precio_venta%TYPE;
+        v_id_venta SGIC_VENTAS.id_venta%TYPE;
+        v_ids t_numeros;
+        v_requeridos t_numeros;
+        v_stocks t_numeros;
+        v_nombres t_nombres;
+
+        FUNCTION formato(n NUMBER) RETURN VARCHAR2 IS
+        BEGIN
+            RETURN RTRIM(TO_CHAR(n, 'FM99999999990.999'), '.');
+        END;
+    BEGIN
+        BEGIN
+            SELECT nombre, precio_venta INTO v_nombre, v_precio FROM SGIC_PRODUCTOS WHERE id_producto = :id_prod;
+        EXCEPTION
+            WHEN NO_DATA_FOUND THEN
+                RAISE_APPLICATION_ERROR(-20002, 'Producto ID ' || :id_prod || ' no encontrado.');
+        END;
+
+        INSERT INTO SGIC_VENTAS (id_producto_fk, cantidad_vendida, precio_unitario_venta, monto_total_venta, fecha_venta, observacion)
+        VALUES (:id_prod, :cantidad, v_precio, v_precio * :cantidad, :fecha, NVL(:observacion, 'Venta de ' || :cantidad || ' x ' || v_nombre))
+        RETURNING id_venta INTO v_id_venta;
+
+        SELECT pi.id_ingrediente_fk, pi.cantidad_necesaria * :cantidad, i.stock_actual, i.nombre
+        BULK COLLECT INTO v_ids, v_requeridos, v_stocks, v_nombres
+        FROM SGIC_PRODUCTO_INGREDIENTES pi
+        JOIN SGIC_INGREDIENTES i ON i.id_ingrediente = pi.id_ingrediente_fk
+        WHERE pi.id_producto_fk = :id_prod
+        FOR UPDATE OF i.stock_actual;
+
+        -- Se validan todos los stocks antes de escribir ninguno
+        FOR i IN 1 .. v_ids.COUNT LOOP
+            IF ROUND(v_stocks(i) - v_requeridos(i), 3) < 0 THEN
+                RAISE_APPLICATION_ERROR(-20001, 'Stock insuficiente para ''' || v_nombres(i) || ''' (ID ' || v_ids(i)
+                    || '). Requiere ' || formato(v_requeridos(i)) || ', disponible ' || formato(v_stocks(i)) || '.');
+            END IF;
+        END LOOP;
+
+        FORALL i IN 1 .. v_ids.COUNT
+            UPDATE SGIC_INGREDIENTES SET stock_actual = ROUND(stock_actual - v_requeridos(i), 3)
+            WHERE id_ingrediente = v_ids(i);
+
+        FORALL i IN 1 .. v_ids.COUNT
+            INSERT INTO SGIC_MOVIMIENTOS_INVENTARIO
+            (id_ingrediente_fk, id_venta_fk, tipo_movimiento, cantidad, fecha_movimiento, observacion)
+            VALUES (v_ids(i), v_id_venta, 'SALIDA_VENTA', v_requeridos(i), :fecha,
+                    'Salida por Venta ID: ' || v_id_venta || ' (' || :cantidad || ' x ''' || v_nombre || ''')');
+
+        :id_venta := v_id_venta;
+        :nombre_producto := v_nombre;
+        :ingredientes_descontados := v_ids.COUNT;
+    END;
+"""
+
 @app.route('/api/inventario/salida_venta_producto', methods=['POST'])
 def registrar_salida_por_venta():
     data = request.get_json()
@@ -689,71 +1121,57 @@ def registrar_salida_por_venta():
     except ValueError:
         return jsonify({"error": "id_producto y cantidad_vendida deben ser números válidos."}), 400
 
-    new_venta_id = None
     try:
-        with get_db_connection() as connection:
+        with get_db_connection(autocommit=True) as connection:
             with connection.cursor() as cursor:
-                cursor.execute("SELECT nombre, precio_venta FROM SGIC_PRODUCTOS WHERE id_producto = :id", {'id': id_producto})
-                producto_info = cursor.fetchone()
-                if not producto_info:
-                    raise ValueError(f"Producto ID {id_producto} no encontrado.")
-                nombre_producto, precio_unitario_actual_db = producto_info[0], Decimal(str(producto_info[1]))
-
-                monto_total_venta = precio_unitario_actual_db * Decimal(str(cantidad_productos_vendidos))
-
-                sql_insert_venta = """
-                    INSERT INTO SGIC_VENTAS (id_producto_fk, cantidad_vendida, precio_unitario_venta, monto_total_venta, fecha_venta, observacion)
-                    VALUES (:id_prod, :cant_vend, :precio_u, :monto_t, :fecha, :obs)
-                    RETURNING id_venta INTO :new_id_venta
-                """
-                new_id_venta_var = cursor.var(oracledb.NUMBER)
-                cursor.execute(sql_insert_venta, {
-                    "id_prod": id_producto, "cant_vend": cantidad_productos_vendidos,
-                    "precio_u": float(precio_unitario_actual_db), "monto_t": float(monto_total_venta),
-                    "fecha": datetime.now(), "obs": data.get("observacion_venta", f"Venta de {cantidad_productos_vendidos} x {nombre_producto}"),
-                    "new_id_venta": new_id_venta_var
+                id_venta_var = cursor.var(int)
+                nombre_producto_var = cursor.var(str)
+                ingredientes_descontados_var = cursor.var(int)
+                cursor.execute(_PLSQL_REGISTRAR_VENTA, {
+                    "id_prod": id_producto, "cantidad": cantidad_productos_vendidos, "fecha": datetime.now(),
+                    "observacion": data.get("observacion_venta"),
+                    "id_venta": id_venta_var, "nombre_producto": nombre_producto_var,
+                    "ingredientes_descontados": ingredientes_descontados_var
                 })
-                new_venta_id = new_id_venta_var.getvalue()[0]
-
-                cursor.execute("SELECT id_ingrediente_fk, cantidad_necesaria FROM SGIC_PRODUCTO_INGREDIENTES WHERE id_producto_fk = :id_prod", {'id_prod': id_producto})
-                ingredientes_receta = cursor.fetchall()
-
-                if not ingredientes_receta and cantidad_productos_vendidos > 0 :
-                    app.logger.info(f"Venta de '{nombre_producto}' (Venta ID: {new_venta_id}) no afecta stock (sin receta).")
-                else:
-                    for id_ing, cant_necesaria_unidad_db in ingredientes_receta:
-                        cant_necesaria_unidad = Decimal(str(cant_necesaria_unidad_db))
-                        cantidad_total_a_descontar = cant_necesaria_unidad * Decimal(str(cantidad_productos_vendidos))
-                        observ_mov = f"Salida por Venta ID: {new_venta_id} ({cantidad_productos_vendidos} x '{nombre_producto}')"
-                        _actualizar_stock_ingrediente_db(id_ing, -cantidad_total_a_descontar, "SALIDA_VENTA", observ_mov, cursor, id_venta=new_venta_id)
-                connection.commit()
+        new_venta_id = id_venta_var.getvalue()
+        nombre_producto = nombre_producto_var.getvalue()
+        _invalidar_cache_reportes()
+        if app.logger.isEnabledFor(logging.INFO):
+            if ingredientes_descontados_var.getvalue():
+                app.logger.info("Venta ID %s: descontado stock de %s ingrediente(s) de '%s'.", new_venta_id, ingredientes_descontados_var.getvalue(), nombre_producto)
+            else:
+                app.logger.info("Venta de '%s' (Venta ID: %s) no afecta stock (sin receta).", nombre_producto, new_venta_id)
 
         return jsonify({
             "mensaje": f"{cantidad_productos_vendidos} x '{nombre_producto}' vendida(s) (Venta ID: {new_venta_id}). Stock actualizado.",
             "id_venta": new_venta_id
         })
-    except ValueError as ve:
-        return jsonify({"error": str(ve)}), 400
+    except oracledb.DatabaseError as e:
+        error_obj, = e.args
+        if error_obj.code in (_ORA_STOCK_INSUFICIENTE, _ORA_PRODUCTO_NO_ENCONTRADO):
+            return jsonify({"error": _mensaje_error_aplicacion(error_obj)}), 400
+        app.logger.error("Error registrando salida por venta: %s", error_obj.message, exc_info=CONFIG.debug_mode)
+        return jsonify({"error": "Error interno del servidor", "detalle": str(e)}), 500
     except Exception as e:
-        app.logger.error(f"Error registrando salida por venta: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error registrando salida por venta: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno del servidor", "detalle": str(e)}), 500
 
 # --- Rutas para Reportes ---
 @app.route('/api/reportes/existencias', methods=['GET'])
 def reporte_existencias():
     try:
-        with get_db_connection() as connection:
+        with get_read_connection() as connection:
             with connection.cursor() as cursor:
+                _ajustar_cursor_listado(cursor)
                 sql = """
                     SELECT id_ingrediente, nombre, unidad_medida, stock_actual, stock_minimo,
                            CASE WHEN stock_actual < stock_minimo THEN 'BAJO STOCK' ELSE 'OK' END as estado_stock
                     FROM SGIC_INGREDIENTES ORDER BY nombre
                 """
-                cursor.execute(sql)
-                existencias = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
-                return jsonify(convert_data_types(existencias))
+                _execute_dict(cursor, sql)
+                return _json_response(cursor.fetchall())
     except Exception as e:
-        app.logger.error(f"Error reporte existencias: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error reporte existencias: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno", "detalle": str(e)}), 500
 
 @app.route('/api/reportes/historial_movimientos', methods=['GET'])
@@ -772,63 +1190,85 @@ def reporte_historial_movimientos():
     except ValueError:
         return jsonify({"error": "Formato de fecha inválido. Usar YYYY-MM-DD."}), 400
 
+    # Rangos de fechas amplios pueden traer muchas filas: se envían como NDJSON a medida que llegan de la BD
+    recursos = ExitStack()
     try:
-        with get_db_connection() as connection:
-            with connection.cursor() as cursor:
-                sql_base = """
-                    SELECT mi.id_movimiento, mi.fecha_movimiento, mi.tipo_movimiento,
-                           i.nombre as nombre_ingrediente, mi.cantidad, i.unidad_medida,
-                           mi.id_venta_fk,
-                           p_venta.nombre as nombre_producto_venta,
-                           mi.observacion
-                    FROM SGIC_MOVIMIENTOS_INVENTARIO mi
-                    JOIN SGIC_INGREDIENTES i ON mi.id_ingrediente_fk = i.id_ingrediente
-                    LEFT JOIN SGIC_VENTAS v ON mi.id_venta_fk = v.id_venta
-                    LEFT JOIN SGIC_PRODUCTOS p_venta ON v.id_producto_fk = p_venta.id_producto
-                """
-                if sql_conditions: sql_base += " WHERE " + " AND ".join(sql_conditions)
-                sql_base += " ORDER BY mi.fecha_movimiento DESC, mi.id_movimiento DESC"
-
-                cursor.execute(sql_base, params)
-                movimientos = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
-                return jsonify(convert_data_types(movimientos))
+        connection = recursos.enter_context(get_read_connection())
+        cursor = recursos.enter_context(connection.cursor())
+        _ajustar_cursor_listado(cursor)
+        sql_base = """
+            SELECT mi.id_movimiento, mi.fecha_movimiento, mi.tipo_movimiento,
+                   i.nombre as nombre_ingrediente, mi.cantidad, i.unidad_medida,
+                   mi.id_venta_fk,
+                   p_venta.nombre as nombre_producto_venta,
+                   mi.observacion
+            FROM SGIC_MOVIMIENTOS_INVENTARIO mi
+            JOIN SGIC_INGREDIENTES i ON mi.id_ingrediente_fk = i.id_ingrediente
+            LEFT JOIN SGIC_VENTAS v ON mi.id_venta_fk = v.id_venta
+            LEFT JOIN SGIC_PRODUCTOS p_venta ON v.id_producto_fk = p_venta.id_producto
+        """
+        if sql_conditions: sql_base += " WHERE " + " AND ".join(sql_conditions)
+        sql_base += " ORDER BY mi.fecha_movimiento DESC, mi.id_movimiento DESC"
+
+        _execute_dict(cursor, sql_base, params)
+        return _ndjson_stream(recursos, cursor)
     except Exception as e:
-        app.logger.error(f"Error historial movimientos: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        recursos.close()
+        app.logger.error("Error historial movimientos: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno", "detalle": str(e)}), 500
 
+# Un texto SQL fijo por sentido de orden (la cache de sentencias indexa por el texto exacto).
+# Se agrega SGIC_VENTAS solo por id_producto_fk y se corta al top :limite antes de unir con
+# SGIC_PRODUCTOS, que aporta únicamente el nombre. Índice sugerido para que la agregación
+# se resuelva leyendo solo el índice (sin tocar la tabla):
+#   CREATE INDEX ix_ventas_prod_cov ON SGIC_VENTAS (id_producto_fk, cantidad_vendida, monto_total_venta);
+_SQL_RANKING_VENTAS = """
+    WITH ventas_por_producto AS (
+        SELECT id_producto_fk,
+               SUM(cantidad_vendida) as total_unidades_vendidas,
+               SUM(monto_total_venta) as total_monto_ventas
+        FROM SGIC_VENTAS
+        GROUP BY id_producto_fk
+        ORDER BY total_unidades_vendidas {orden}, total_monto_ventas {orden}
+        FETCH FIRST :limite ROWS ONLY
+    )
+    SELECT p.id_producto, p.nombre as nombre_producto,
+           a.total_unidades_vendidas, a.total_monto_ventas
+    FROM ventas_por_producto a
+    JOIN SGIC_PRODUCTOS p ON p.id_producto = a.id_producto_fk
+    ORDER BY a.total_unidades_vendidas {orden}, a.total_monto_ventas {orden}
+"""
+_SQL_RANKING_VENTAS_POR_ORDEN = {
+    'asc': _SQL_RANKING_VENTAS.format(orden='ASC'),
+    'desc': _SQL_RANKING_VENTAS.format(orden='DESC'),
+}
+
 @app.route('/api/reportes/productos_ranking_ventas', methods=['GET'])
 def reporte_productos_ranking_ventas():
     orden = request.args.get('orden', 'desc').lower()
     limite = request.args.get('limite', default=10, type=int)
     if orden not in ['asc', 'desc']:
         return jsonify({"error": "Parámetro 'orden' debe ser 'asc' o 'desc'."}), 400
+    if limite < 1:
+        return jsonify({"error": "Parámetro 'limite' debe ser un entero positivo."}), 400
 
-    try:
-        with get_db_connection() as connection:
+    def consultar():
+        with get_read_connection() as connection:
             with connection.cursor() as cursor:
-                sql = f"""
-                    SELECT
-                        p.id_producto, p.nombre as nombre_producto,
-                        SUM(v.cantidad_vendida) as total_unidades_vendidas,
-                        SUM(v.monto_total_venta) as total_monto_ventas
-                    FROM SGIC_VENTAS v
-                    JOIN SGIC_PRODUCTOS p ON v.id_producto_fk = p.id_producto
-                    GROUP BY p.id_producto, p.nombre
-                    ORDER BY total_unidades_vendidas { 'ASC' if orden == 'asc' else 'DESC' }, total_monto_ventas { 'ASC' if orden == 'asc' else 'DESC' }
-                    FETCH FIRST :limite ROWS ONLY
-                """
-                cursor.execute(sql, {'limite': limite})
-                productos = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
-                return jsonify(convert_data_types(productos))
+                _execute_dict(cursor, _SQL_RANKING_VENTAS_POR_ORDEN[orden], {'limite': limite})
+                return cursor.fetchall()
+    try:
+        return _reporte_cacheado(('productos_ranking_ventas', orden, limite), consultar)
     except Exception as e:
-        app.logger.error(f"Error ranking productos: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error ranking productos: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno", "detalle": str(e)}), 500
 
 @app.route('/api/reportes/promedio_ventas_diarias', methods=['GET'])
 def reporte_promedio_ventas_diarias():
-    try:
-        with get_db_connection() as connection:
+    def consultar():
+        with get_read_connection() as connection:
             with connection.cursor() as cursor:
+                _ajustar_cursor_listado(cursor)
                 sql = """
                     SELECT
                         TRUNC(fecha_venta) as dia_venta,
@@ -838,29 +1278,30 @@ def reporte_promedio_ventas_diarias():
                     GROUP BY TRUNC(fecha_venta)
                     ORDER BY dia_venta DESC
                 """
-                cursor.execute(sql)
-                ventas_diarias_detalle = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+                _execute_dict(cursor, sql)
+                ventas_diarias_detalle = cursor.fetchall()
 
+                # Los totales ya llegan como números de la BD: se promedian directamente, sin pasar por str/Decimal
                 promedio_general_diario = 0
                 if ventas_diarias_detalle:
-                    total_monto_todos_los_dias = sum(Decimal(str(d['total_venta_dia'])) for d in ventas_diarias_detalle)
-                    numero_dias_con_ventas = len(ventas_diarias_detalle)
-                    if numero_dias_con_ventas > 0:
-                        promedio_general_diario = total_monto_todos_los_dias / Decimal(str(numero_dias_con_ventas))
+                    promedio_general_diario = sum(d['total_venta_dia'] for d in ventas_diarias_detalle) / len(ventas_diarias_detalle)
 
-                return jsonify({
-                    "detalle_por_dia": convert_data_types(ventas_diarias_detalle),
+                return {
+                    "detalle_por_dia": ventas_diarias_detalle,
                     "promedio_general_monto_diario": float(promedio_general_diario)
-                })
+                }
+    try:
+        return _reporte_cacheado(('promedio_ventas_diarias',), consultar)
     except Exception as e:
-        app.logger.error(f"Error promedio ventas diarias: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error promedio ventas diarias: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno", "detalle": str(e)}), 500
 
 @app.route('/api/reportes/promedio_ventas_mensuales', methods=['GET'])
 def reporte_promedio_ventas_mensuales():
-    try:
-        with get_db_connection() as connection:
+    def consultar():
+        with get_read_connection() as connection:
             with connection.cursor() as cursor:
+                _ajustar_cursor_listado(cursor)
                 sql = """
                     SELECT
                         TO_CHAR(fecha_venta, 'YYYY-MM') as mes_venta,
@@ -870,35 +1311,41 @@ def reporte_promedio_ventas_mensuales():
                     GROUP BY TO_CHAR(fecha_venta, 'YYYY-MM')
                     ORDER BY mes_venta DESC
                 """
-                cursor.execute(sql)
-                ventas_mensuales_detalle = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+                _execute_dict(cursor, sql)
+                ventas_mensuales_detalle = cursor.fetchall()
 
                 promedio_general_mensual = 0
                 if ventas_mensuales_detalle:
-                    total_monto_todos_los_meses = sum(Decimal(str(m['total_venta_mes'])) for m in ventas_mensuales_detalle)
-                    numero_meses_con_ventas = len(ventas_mensuales_detalle)
-                    if numero_meses_con_ventas > 0:
-                        promedio_general_mensual = total_monto_todos_los_meses / Decimal(str(numero_meses_con_ventas))
+                    promedio_general_mensual = sum(m['total_venta_mes'] for m in ventas_mensuales_detalle) / len(ventas_mensuales_detalle)
 
-                return jsonify({
-                    "detalle_por_mes": convert_data_types(ventas_mensuales_detalle),
+                return {
+                    "detalle_por_mes": ventas_mensuales_detalle,
                     "promedio_general_monto_mensual": float(promedio_general_mensual)
-                })
+                }
+    try:
+        return _reporte_cacheado(('promedio_ventas_mensuales',), consultar)
     except Exception as e:
-        app.logger.error(f"Error promedio ventas mensuales: {e}\n{traceback.format_exc() if DEBUG_MODE else ''}")
+        app.logger.error("Error promedio ventas mensuales: %s", e, exc_info=CONFIG.debug_mode)
         return jsonify({"error": "Error interno", "detalle": str(e)}), 500
 
 # --- Error Handlers y __main__ ---
+# Cuerpos serializados una sola vez al importar. El Response se crea en cada petición porque
+# after_request (p. ej. CORS) modifica sus cabeceras y no puede compartirse entre peticiones.
+_CUERPO_404 = orjson.dumps({"error": "Endpoint no encontrado"})
+_CUERPO_405 = orjson.dumps({"error": "Método no permitido"})
+_CUERPO_500 = orjson.dumps({"error": "Error interno del servidor (manejador general)"})
+
 @app.errorhandler(404)
-def not_found_error(error): return jsonify({"error": "Endpoint no encontrado"}), 404
+def not_found_error(error): return app.response_class(_CUERPO_404, status=404, mimetype='application/json')
 @app.errorhandler(405)
-def method_not_allowed_error(error): return jsonify({"error": "Método no permitido"}), 405
+def method_not_allowed_error(error): return app.response_class(_CUERPO_405, status=405, mimetype='application/json')
 @app.errorhandler(500)
 def internal_server_error_handler(error):
     original_exception = getattr(error, 'original_exception', error)
-    app.logger.error(f"Error 500: {original_exception}\n{traceback.format_exc() if DEBUG_MODE else ''}")
-    return jsonify({"error": "Error interno del servidor (manejador general)"}), 500
+    app.logger.error("Error 500: %s", original_exception, exc_info=CONFIG.debug_mode)
+    return app.response_class(_CUERPO_500, status=500, mimetype='application/json')
 
+# Servidor de desarrollo. En producción: gunicorn -c gunicorn.conf.py app:app (ver gunicorn.conf.py)
 if __name__ == '__main__':
     app.logger.info("--------------------------------------------------")
     app.logger.info(f"Iniciando el servidor Flask SGIC (app.run) para __name__: {__name__}")
@@ -912,8 +1359,10 @@ if __name__ == '__main__':
 
     host = os.environ.get('FLASK_HOST', '0.0.0.0')
     port = int(os.environ.get('FLASK_PORT', '5000'))
-    run_debug_mode = DEBUG_MODE
+    run_debug_mode = CONFIG.debug_mode
 
+    if not run_debug_mode:
+        app.logger.warning("app.run es el servidor de desarrollo de Flask; para producción usar 'gunicorn -c gunicorn.conf.py app:app'.")
     app.logger.info(f"Iniciando servidor en http://{host}:{port}/ (Flask debug={run_debug_mode})")
-    app.run(host=host, port=port, debug=run_debug_mode)
+    app.run(host=host, port=port, debug=run_debug_mode, threaded=True)
 
@@ -0,0 +1,22 @@
+# Configuración de Gunicorn para producción:
+#   gunicorn -c gunicorn.conf.py app:app
+# app.run (python app.py) queda solo para desarrollo.
+import multiprocessing
+import os
+
+bind = f"{os.environ.get('FLASK_HOST', '0.0.0.0')}:{os.environ.get('FLASK_PORT', '5000')}"
+
+# Hilos por worker: python-oracledb libera el GIL mientras espera a la BD.
+# Cada worker tiene sus propios pools, así que DB_POOL_MAX debe ser >= threads, y también
+# DB_READ_POOL_SIZE (pool de reportes; por defecto toma el valor de DB_POOL_MAX).
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# Cada worker importa app.py después del fork y crea ahí su pool de conexiones:
+# un pool creado en el proceso maestro y heredado por fork no es utilizable.
+preload_app = False
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+accesslog = '-'
+errorlog = '-'